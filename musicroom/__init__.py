@@ -1,41 +1,154 @@
 from flask import Flask
 from flask_oauth import OAuth, OAuthException
-from pyechonest import config
-from redis import StrictRedis
+from pyechonest import config, util as echonest_util
 from rdio import Rdio
-
-domain = 'localhost'
+from lazy import PerProcess
+import httplib2
+import json
+import oauth2
+import os
+import threading
 
 app = Flask(__name__)
 
+# Defaults, for development. create_app overrides them from the environment.
 app.config['MONGO_DBNAME'] = 'db'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////db.sqlite'
-app.secret_key = 'super secret'
-app.debug = True
+app.config['DATABASE'] = 'musicroom.db'
+app.config['REDIS_URL'] = 'redis://localhost:6379/0'
+app.config['DOMAIN'] = 'localhost'
+app.config['SECRET_KEY'] = 'super secret'
+app.config['DEBUG'] = True
+app.config['JOB_WORKERS'] = 4
+app.config['UPSTREAM_CONCURRENCY'] = 8
+app.config['BACKGROUND_CONCURRENCY'] = 4
+app.config['UPSTREAM_RETRIES'] = 3
+app.config['WRITE_BATCH_SIZE'] = 100
+app.config['WRITE_DELAY'] = 0.0
+app.config['WRITE_TIMEOUT'] = 30.0
+app.config['RDIO_CONSUMER'] = ('yjgnkcp2kr8ykwwjtujb5ajv', 'trpsv6n6gm')
+app.config['RDIO_URL'] = 'http://api.rdio.com/'
+app.config['RDIO_TIMEOUT'] = 10.0
+app.config['RDIO_RETRIES'] = 2
+app.config['ECHO_NEST_HOST'] = 'developer.echonest.com'
+app.config['ECHO_NEST_API_KEY'] = 'ZMBQQBZ4DBZVTKOTB'
+app.config['FACEBOOK_URL'] = 'https://graph.facebook.com/'
+app.config['FACEBOOK_AUTHORIZE_URL'] = 'https://www.facebook.com/dialog/oauth'
+app.config['FACEBOOK_CONSUMER'] = ('255490651260325', '8fd6a30d356b85bfa58daa327c9eacea')
+app.config['SLOW_REQUEST_SECONDS'] = 1.0
+app.config['SLOW_REQUEST_SAMPLE_RATE'] = 1.0
+app.config['METRICS_FLUSH_INTERVAL'] = 5.0
+# Where rooms live, as name -> [database, redis url] (see musicroom/shards.py).
+# With none, rooms live alongside users in DATABASE and REDIS_URL.
+app.config['SHARDS'] = {}
+
+ENVIRON_PREFIX = 'MUSICROOM_'
+
+def _parse_setting(value, default):
+  if isinstance(default, bool):
+    return value.lower() in ('1', 'true', 'yes', 'on')
+  if isinstance(default, (int, long)):
+    return int(value)
+  if isinstance(default, float):
+    return float(value)
+  if isinstance(default, tuple):
+    return tuple(value.split(','))
+  if isinstance(default, dict):
+    return json.loads(value)
+  return value
+
+# from_environ : Config -> ()
+# Overrides every setting that has a MUSICROOM_<NAME> environment variable,
+# parsed like the setting's current value: numbers as numbers, booleans from
+# 1/true/yes/on, pairs such as RDIO_CONSUMER as comma separated and
+# dictionaries such as SHARDS as JSON.
+def from_environ(config):
+  for name, default in config.items():
+    value = os.environ.get(ENVIRON_PREFIX + name)
+    if value is not None:
+      config[name] = _parse_setting(value, default)
 
-config.ECHO_NEST_API_KEY = 'ZMBQQBZ4DBZVTKOTB'
+from musicroom.metrics import TimedRedis, TimedTransport, EchoNestTimer, timed, cache
+
+echonest_util.opener.add_handler(EchoNestTimer())
 
 oauth = OAuth()
 facebook = oauth.remote_app('facebook',
-  base_url='https://graph.facebook.com/',
+  base_url=app.config['FACEBOOK_URL'],
   request_token_url=None,
   access_token_url='/oauth/access_token',
-  authorize_url='https://www.facebook.com/dialog/oauth',
-  consumer_key='255490651260325',
-  consumer_secret='8fd6a30d356b85bfa58daa327c9eacea',
+  authorize_url=app.config['FACEBOOK_AUTHORIZE_URL'],
+  consumer_key=app.config['FACEBOOK_CONSUMER'][0],
+  consumer_secret=app.config['FACEBOOK_CONSUMER'][1],
   request_token_params={'scope': 'email'}
 )
 
-redis = StrictRedis()
+class _ThreadLocalHttp(object):
+  """An httplib2.Http per thread. Flask-OAuth exchanges sign in codes for
+  tokens over a single shared one, and concurrent sign ins hang on it."""
+
+  def __init__(self):
+    self._local = threading.local()
+
+  def request(self, *args, **kwargs):
+    if not hasattr(self._local, 'http'):
+      self._local.http = httplib2.Http()
+    with timed('api', 'facebook:access_token'):
+      return self._local.http.request(*args, **kwargs)
+
+facebook._client = _ThreadLocalHttp()
+
+redis = PerProcess(lambda: TimedRedis.from_url(app.config['REDIS_URL']))
+
+# Playback tokens are tied to the domain and good for a long time; share one
+# between all workers and fetch a fresh one now and then.
+RDIO_TOKEN_TTL = 24 * 60 * 60
+
+_rdio = PerProcess(lambda: Rdio(
+  app.config['RDIO_CONSUMER'],
+  transport=TimedTransport(timeout=app.config['RDIO_TIMEOUT'], retries=app.config['RDIO_RETRIES']),
+  base_url=app.config['RDIO_URL']
+))
+def rdio():
+  return _rdio.resource()
 
-_rdio_token = None
-_rdio = Rdio(('yjgnkcp2kr8ykwwjtujb5ajv', 'trpsv6n6gm'))
 def rdio_token():
-  global _rdio_token
-  if _rdio_token is None:
-    _rdio_token = _rdio.call('getPlaybackToken', {'domain': domain})['result']
-  return _rdio_token
+  domain = app.config['DOMAIN']
+  key = 'rdio:playback_token:' + domain
+  token = redis.get(key)
+  cache('rdio_token', token is not None)
+  if token is None:
+    token = rdio().call('getPlaybackToken', {'domain': domain})['result']
+    redis.set(key, token, ex=RDIO_TOKEN_TTL)
+  return token
+
+# create_app : (string, object) dict -> Flask
+# Configures the app from, in increasing order of precedence, the defaults
+# above, the file named by MUSICROOM_SETTINGS (e.g. utils/fake_settings.py),
+# MUSICROOM_<NAME> environment variables and the given settings, and returns
+# it. Connections and threads are only made on first use in each process, so
+# this is safe to call in a pre-forking server's master process.
+def create_app(settings=None):
+  app.config.from_envvar('MUSICROOM_SETTINGS', silent=True)
+  from_environ(app.config)
+  if settings:
+    app.config.update(settings)
+
+  config.ECHO_NEST_API_KEY = app.config['ECHO_NEST_API_KEY']
+  config.API_HOST = app.config['ECHO_NEST_HOST']
+
+  facebook.base_url = app.config['FACEBOOK_URL']
+  facebook.authorize_url = app.config['FACEBOOK_AUTHORIZE_URL']
+  facebook.consumer_key, facebook.consumer_secret = app.config['FACEBOOK_CONSUMER']
+  facebook._consumer = oauth2.Consumer(facebook.consumer_key, facebook.consumer_secret)
+
+  # Connections already made were made with the old settings.
+  for resource in (redis, _rdio, musicroom.database._pool, musicroom.writer._writer, musicroom.shards._shards):
+    resource.discard()
+  return app
 
 import musicroom.login
+import musicroom.database
+import musicroom.shards
 import musicroom.models
 import musicroom.views
@@ -0,0 +1,75 @@
+from musicroom import app, metrics
+from musicroom.lazy import PerProcess
+from concurrent.futures import ThreadPoolExecutor
+from pyechonest.util import EchoNestAPIError, EchoNestIOError
+import threading
+import time
+
+# Echo Nest calls that don't depend on each other run on a pool of their own,
+# so that a request waits for the slowest of them rather than their sum. The
+# pool's size (UPSTREAM_CONCURRENCY) bounds how many calls this process has
+# in flight at once for requests. Calls nobody waits for go to a second pool
+# (BACKGROUND_CONCURRENCY), so that their retries can't hold up requests.
+RETRY_DELAY = 0.5
+RATE_LIMITED = 3 # Echo Nest's error code for too many requests
+
+_executor = PerProcess(lambda: ThreadPoolExecutor(max_workers=app.config['UPSTREAM_CONCURRENCY']))
+def executor():
+  return _executor.resource()
+
+_background = PerProcess(lambda: ThreadPoolExecutor(max_workers=app.config['BACKGROUND_CONCURRENCY']))
+
+# Code already running on the pool makes its calls inline; waiting on the pool
+# from inside it could leave every worker waiting on work nobody can start.
+_worker = threading.local()
+
+# Calls made for a request count towards its breakdown (see metrics) wherever
+# they run.
+def _run(fn, args, kwargs, breakdown=None):
+  _worker.active = True
+  metrics.attach(breakdown)
+  try:
+    return fn(*args, **kwargs)
+  finally:
+    _worker.active = False
+    metrics.attach(None)
+
+# concurrently : (a -> b) function, a list -> b list
+# fn applied to each item, in order, with the calls made in parallel. Raises
+# the first item's exception if any of them fail.
+def concurrently(fn, items):
+  items = list(items)
+  if len(items) <= 1 or getattr(_worker, 'active', False):
+    return [fn(item) for item in items]
+  breakdown = metrics.current()
+  futures = [executor().submit(_run, fn, (item,), {}, breakdown) for item in items]
+  return [future.result() for future in futures]
+
+def _transient(e):
+  return isinstance(e, EchoNestIOError) or (isinstance(e, EchoNestAPIError) and e.code == RATE_LIMITED)
+
+# retrying : (... -> a) function, ... -> a
+# fn(*args, **kwargs), tried again (after a growing pause) on network errors
+# and rate limiting, up to UPSTREAM_RETRIES more times
+def retrying(fn, *args, **kwargs):
+  attempt = 0
+  while True:
+    try:
+      return fn(*args, **kwargs)
+    except Exception as e:
+      if not _transient(e) or attempt >= app.config['UPSTREAM_RETRIES']:
+        raise
+      attempt += 1
+      time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+
+# background : (... -> ()) function, ... -> ()
+# Runs fn(*args, **kwargs) on the background pool without waiting for it.
+# Failures are logged, since nobody is waiting to hear about them. Calls it
+# makes through concurrently run inline, keeping them off the request pool.
+def background(fn, *args, **kwargs):
+  def logged():
+    try:
+      fn(*args, **kwargs)
+    except Exception:
+      app.logger.exception('background call %s failed', fn.__name__)
+  _background.resource().submit(_run, logged, (), {})
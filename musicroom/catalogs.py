@@ -0,0 +1,76 @@
+from musicroom import jobs, shards
+import time
+
+# Seconds between catalog ticket status checks. The delay doubles after every
+# check that isn't complete, up to the maximum.
+POLL_INITIAL = 0.1
+POLL_MAX = 5.0
+
+# A push keeps going while the room changes underneath it, but gives up
+# (until the next change) after this many rounds.
+MAX_ROUNDS = 5
+
+# pushed_counts : string -> (string, int) dict
+# the artist play counts the room's seed catalog was last sent
+def pushed_counts(room_id):
+  cur = shards.for_room(room_id).db().execute('select artist_fbid, play_count from catalog_item where room_id = ?', (room_id,))
+  return dict(cur.fetchall())
+
+# delta : (string, int) dict, (string, int) dict -> (item list, (string, int) dict, string list)
+# The catalog update items that turn `pushed` into `wanted`, along with the
+# changed counts and the deleted artists they amount to.
+def delta(wanted, pushed):
+  changed = dict((artist, count) for artist, count in wanted.iteritems() if pushed.get(artist) != count)
+  deleted = [artist for artist in pushed if artist not in wanted]
+  items = []
+  for artist, count in changed.iteritems():
+    items.append({'action': 'update', 'item': {'item_id': artist, 'artist_id': 'facebook:artist:' + artist, 'play_count': count}})
+  for artist in deleted:
+    items.append({'action': 'delete', 'item': {'item_id': artist}})
+  return items, changed, deleted
+
+# wait_for : Catalog, string, progress -> ()
+def wait_for(cat, ticket, progress):
+  delay = POLL_INITIAL
+  while True:
+    status = cat.status(ticket)
+    progress(ticket_status=status['ticket_status'], percent_complete=status.get('percent_complete'))
+    if status['ticket_status'] == 'complete':
+      return
+    if status['ticket_status'] == 'error':
+      from musicroom.models import APIError
+      raise APIError('catalog update failed: ' + str(status.get('details')))
+    time.sleep(delay)
+    delay = min(delay * 2, POLL_MAX)
+
+# push : Room, progress -> int
+# Sends the room's seed catalog only what changed since the last push and
+# records what it now holds. Returns the number of items sent.
+def push(room, progress=lambda **fields: None):
+  sent = 0
+  for i in xrange(MAX_ROUNDS):
+    cat = room.seed_catalog()
+    items, changed, deleted = delta(room.artist_counts(), pushed_counts(room.id()))
+    if not items:
+      break
+    wait_for(cat, cat.update(items), progress)
+    statements = [('insert or replace into catalog_item values (?, ?, ?)', (room.id(), artist, count))
+                  for artist, count in changed.iteritems()]
+    statements += [('delete from catalog_item where room_id = ? and artist_fbid = ?', (room.id(), artist))
+                   for artist in deleted]
+    room.shard().write(*statements)
+    sent += len(items)
+  return sent
+
+# schedule_push : string -> string
+# queues a push for the room, returning the job id
+def schedule_push(room_id):
+  return jobs.submit('catalog:' + room_id, _push_job, room_id)
+
+def _push_job(progress, room_id):
+  from musicroom.models import Room, NonexistentError
+  try:
+    room = Room(room_id)
+  except NonexistentError:
+    return {'sent': 0} # deleted in the meantime
+  return {'sent': push(room, progress)}
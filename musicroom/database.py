@@ -0,0 +1,82 @@
+from musicroom import app
+from musicroom.lazy import PerProcess
+from musicroom.metrics import TimedConnection
+from flask import g, has_request_context
+import sqlite3
+import threading
+
+# Applied once to every new connection. WAL lets readers carry on while a
+# like/dislike is being written, and synchronous = normal only fsyncs at
+# checkpoints, which is safe in WAL mode.
+PRAGMAS = (
+  'pragma journal_mode = wal',
+  'pragma synchronous = normal',
+  'pragma cache_size = -8000',
+  'pragma temp_store = memory',
+)
+
+class Pool(object):
+  """Keeps one open connection per thread for the life of the thread.
+
+  sqlite3 connections may only be used from the thread that created them, so
+  the pool is thread-local rather than a shared queue. Because connections
+  are reused, sqlite3's per-connection statement cache means each query in
+  models.py is only prepared once per thread.
+  """
+
+  def __init__(self, path, pragmas=PRAGMAS, timeout=5.0, cached_statements=200, factory=sqlite3.Connection):
+    self._path = path
+    self._pragmas = pragmas
+    self._timeout = timeout
+    self._cached_statements = cached_statements
+    self._factory = factory
+    self._local = threading.local()
+
+  # connection : () -> sqlite3.Connection
+  def connection(self):
+    conn = getattr(self._local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(
+        self._path,
+        timeout=self._timeout,
+        cached_statements=self._cached_statements,
+        factory=self._factory
+      )
+      for pragma in self._pragmas:
+        conn.execute(pragma)
+      self._local.conn = conn
+    return conn
+
+  # release : sqlite3.Connection -> ()
+  # hands a connection back; anything left uncommitted is thrown away
+  def release(self, conn):
+    conn.rollback()
+
+_pool = PerProcess(lambda: Pool(app.config['DATABASE'], factory=TimedConnection))
+def pool():
+  return _pool.resource()
+
+# db : () -> sqlite3.Connection
+def db():
+  return checkout(_pool)
+
+# checkout : PerProcess -> sqlite3.Connection
+# A connection from the given pool (see shards for the others). Connections
+# are only checked out the first time a request touches the database, so
+# static files and redirects never pay for one. Outside of a request
+# (background jobs, scripts) the calling thread's connection is used.
+def checkout(pool):
+  pool = pool.resource()
+  if not has_request_context():
+    return pool.connection()
+  if not hasattr(g, 'db'):
+    g.db = {}
+  conn = g.db.get(pool)
+  if conn is None:
+    conn = g.db[pool] = pool.connection()
+  return conn
+
+@app.teardown_request
+def teardown_request(exception):
+  for pool, conn in getattr(g, 'db', {}).iteritems():
+    pool.release(conn)
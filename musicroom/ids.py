@@ -0,0 +1,107 @@
+from musicroom import redis
+import os
+import socket
+import threading
+import time
+import uuid
+
+# Room ids are built from the time in milliseconds, a node number unique to
+# the process and a per-millisecond sequence, so two rooms can never get the
+# same id and creating one never has to check the database first.
+EPOCH = 1356998400000 # 2013-01-01, in milliseconds
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+
+# A process holds its node number on a lease in redis, renewed as it makes
+# ids, so a number is only handed out again once its last holder has gone
+# quiet for this many seconds.
+NODE_LEASE = 60
+
+RENEW_SCRIPT = '''
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+  return 0
+end
+redis.call('expire', KEYS[1], tonumber(ARGV[2]))
+return 1
+'''
+
+ALPHABET = 'abcdefghijklmnopqrstuvwxyz'
+
+# encode : int -> string
+def encode(n):
+  digits = []
+  while True:
+    n, digit = divmod(n, len(ALPHABET))
+    digits.append(ALPHABET[digit])
+    if n == 0:
+      break
+  return ''.join(reversed(digits))
+
+class IdAllocator(object):
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._pid = None
+    self._owner = None
+    self._node = None
+    self._renewed = 0
+    self._last = 0
+    self._sequence = 0
+
+  # _lease : () -> int
+  # Takes the first free node number, starting from the next one in turn so
+  # that processes spread over them.
+  def _lease(self):
+    start = redis.incr('ids:node')
+    for i in xrange(1 << NODE_BITS):
+      node = (start + i) % (1 << NODE_BITS)
+      if redis.set('ids:node:%d' % node, self._owner, ex=NODE_LEASE, nx=True):
+        return node
+    raise Exception('no free node numbers for room ids')
+
+  # _claim_node : () -> int
+  # After a fork the child must not share its parent's node, so the pid is
+  # checked each time. The lease is renewed a few times per NODE_LEASE; if
+  # it has run out and been taken, the process moves to a new node.
+  def _claim_node(self):
+    now = time.time()
+    if self._pid != os.getpid():
+      self._owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+      self._node = self._lease()
+      self._pid = os.getpid()
+      self._renewed = now
+      self._last = 0
+      self._sequence = 0
+    elif now - self._renewed > NODE_LEASE / 3.0:
+      if not redis.eval(RENEW_SCRIPT, 1, 'ids:node:%d' % self._node, self._owner, NODE_LEASE):
+        self._node = self._lease()
+      self._renewed = now
+    return self._node
+
+  # next_id : () -> string
+  def next_id(self):
+    with self._lock:
+      node = self._claim_node()
+      now = int(time.time() * 1000)
+      if now < self._last:
+        # The clock went backwards; don't reuse milliseconds we've handed out.
+        now = self._last
+      if now == self._last:
+        self._sequence += 1
+        if self._sequence >> SEQUENCE_BITS:
+          # Sequence exhausted for this millisecond; move on to the next one.
+          while now <= self._last:
+            time.sleep(0.0005)
+            now = int(time.time() * 1000)
+          self._sequence = 0
+      else:
+        self._sequence = 0
+      self._last = now
+      return encode(((now - EPOCH) << (NODE_BITS + SEQUENCE_BITS)) |
+                    (node << SEQUENCE_BITS) |
+                    self._sequence)
+
+_allocator = IdAllocator()
+
+# next_id : () -> string
+def next_id():
+  return _allocator.next_id()
@@ -0,0 +1,147 @@
+from musicroom import app, redis
+from musicroom.lazy import PerProcess
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+import time
+import uuid
+
+# How long finished jobs (and their results) stay readable.
+JOB_TTL = 60 * 60
+
+# A queued or running job's dedup lock lasts this many seconds unless the
+# process it was submitted in renews it, which it does every
+# HEARTBEAT_INTERVAL. If that process dies, the lock runs out and the job is
+# reported as abandoned.
+LOCK_TTL = 60
+HEARTBEAT_INTERVAL = 10
+
+# Takes the dedup lock for a new job and writes the job's state in the same
+# step, so that nobody is handed a job id whose state isn't there yet. Returns
+# the id of the job that holds the lock, whichever it is.
+SUBMIT_SCRIPT = '''
+local existing = redis.call('get', KEYS[1])
+if existing then
+  return existing
+end
+redis.call('set', KEYS[1], ARGV[1])
+redis.call('expire', KEYS[1], tonumber(ARGV[2]))
+redis.call('hset', KEYS[2], 'status', 'queued')
+redis.call('hset', KEYS[2], 'key', ARGV[3])
+redis.call('hset', KEYS[2], 'heartbeat', ARGV[4])
+redis.call('expire', KEYS[2], tonumber(ARGV[5]))
+return ARGV[1]
+'''
+
+# Renews the lock if the job still holds it, and keeps the job's state from
+# expiring while the job is alive.
+REFRESH_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+  redis.call('expire', KEYS[1], tonumber(ARGV[2]))
+end
+if redis.call('exists', KEYS[2]) == 1 then
+  redis.call('hset', KEYS[2], 'heartbeat', ARGV[3])
+  redis.call('expire', KEYS[2], tonumber(ARGV[4]))
+end
+return 1
+'''
+
+_executor = PerProcess(lambda: ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS']))
+def executor():
+  return _executor.resource()
+
+def _job_key(job_id):
+  return 'job:' + job_id
+
+def _lock_key(dedup_key):
+  return 'job-lock:' + dedup_key
+
+class Heartbeat(object):
+  """Renews the locks of this process's queued and running jobs and notes
+  the time in their state, from a daemon thread."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._jobs = {}
+    thread = threading.Thread(target=self._run, name='job-heartbeat')
+    thread.daemon = True
+    thread.start()
+
+  # add : string, string -> ()
+  def add(self, job_id, dedup_key):
+    with self._lock:
+      self._jobs[job_id] = dedup_key
+
+  # remove : string -> ()
+  def remove(self, job_id):
+    with self._lock:
+      self._jobs.pop(job_id, None)
+
+  def _run(self):
+    while True:
+      time.sleep(HEARTBEAT_INTERVAL)
+      with self._lock:
+        jobs = self._jobs.items()
+      for job_id, dedup_key in jobs:
+        try:
+          redis.eval(REFRESH_SCRIPT, 2, _lock_key(dedup_key), _job_key(job_id),
+                     job_id, LOCK_TTL, int(time.time()), JOB_TTL)
+        except Exception:
+          app.logger.exception('heartbeat for job %s (%s) failed', job_id, dedup_key)
+
+_heartbeat = PerProcess(Heartbeat)
+
+# submit : string, (progress, ... -> json) function, ... -> string
+# Runs fn(progress, *args) on the local worker pool and returns a job id that
+# status() understands. While a job with the same dedup_key is queued or
+# running, its id is returned instead of starting a second one. Job state is
+# kept in redis so that any web worker can report on it.
+def submit(dedup_key, fn, *args):
+  job_id = uuid.uuid4().hex
+  holder = redis.eval(SUBMIT_SCRIPT, 2, _lock_key(dedup_key), _job_key(job_id),
+                      job_id, LOCK_TTL, dedup_key, int(time.time()), JOB_TTL)
+  if holder != job_id:
+    return holder
+
+  _heartbeat.resource().add(job_id, dedup_key)
+  executor().submit(_run, job_id, dedup_key, fn, args)
+  return job_id
+
+# status : string -> (string, object) dict
+# {'status': 'queued' | 'running' | 'complete' | 'error', 'progress': ...,
+#  'result': ..., 'error': ...}, or None for unknown or expired jobs. A job
+# whose process stopped renewing it is an error.
+def status(job_id):
+  fields = redis.hgetall(_job_key(job_id))
+  if not fields:
+    return None
+  result = {'status': fields['status']}
+  if (fields['status'] in ('queued', 'running') and
+      time.time() - int(fields.get('heartbeat', 0)) > LOCK_TTL):
+    result['status'] = 'error'
+    fields['error'] = 'abandoned: the worker running it stopped'
+  for name in ('progress', 'result'):
+    if name in fields:
+      result[name] = json.loads(fields[name])
+  if 'error' in fields:
+    result['error'] = fields['error']
+  return result
+
+def _run(job_id, dedup_key, fn, args):
+  key = _job_key(job_id)
+
+  def progress(**fields):
+    redis.hset(key, 'progress', json.dumps(fields))
+
+  redis.hset(key, 'status', 'running')
+  try:
+    result = fn(progress, *args)
+  except Exception as e:
+    app.logger.exception('job %s (%s) failed', job_id, dedup_key)
+    redis.hmset(key, {'status': 'error', 'error': str(e)})
+  else:
+    redis.hmset(key, {'status': 'complete', 'result': json.dumps(result)})
+  finally:
+    _heartbeat.resource().remove(job_id)
+    if redis.get(_lock_key(dedup_key)) == job_id:
+      redis.delete(_lock_key(dedup_key))
@@ -0,0 +1,38 @@
+import os
+import threading
+
+class PerProcess(object):
+  """Something that can't be shared across a fork (connection pools, worker
+  threads, open sockets), built on first use in each process.
+
+  A pre-forking server loads the app once and forks its workers from that;
+  anything built before the fork is rebuilt the first time a worker uses it.
+  Attribute access is forwarded to the built object, so a PerProcess can
+  stand in for a module level client.
+  """
+
+  def __init__(self, build):
+    self.__build = build
+    self.__pid = None
+    self.__value = None
+    self.__lock = threading.Lock()
+
+  # resource : () -> object
+  def resource(self):
+    pid = os.getpid()
+    if self.__pid != pid:
+      with self.__lock:
+        if self.__pid != pid:
+          self.__value = self.__build()
+          self.__pid = pid
+    return self.__value
+
+  # discard : () -> ()
+  # forgets the built object, e.g. after the settings it was built from change
+  def discard(self):
+    with self.__lock:
+      self.__pid = None
+      self.__value = None
+
+  def __getattr__(self, name):
+    return getattr(self.resource(), name)
@@ -1,8 +1,11 @@
 from musicroom import facebook, app
-from flask import request, session, url_for, redirect
+from musicroom.models import forget_identity
+from flask import request, session, url_for, redirect, flash
 
 @facebook.tokengetter
 def get_facebook_token(token=None):
+  if token is not None:
+    return token
   return session.get('facebook_token')
 
 @app.route('/login')
@@ -17,6 +20,15 @@ def facebook_authorized(resp):
     flash(u'You denied the request to sign in.')
     return redirect(request.args.get('next'))
 
+  if 'facebook_token' in session:
+    forget_identity(session['facebook_token'])
   session['facebook_token'] = (resp['access_token'], '')
 
   return redirect(request.args.get('next'))
+
+# Re-reads the logged in user's name etc. from Facebook.
+@app.route('/login/refresh')
+def refresh_login():
+  if 'facebook_token' in session:
+    forget_identity(session['facebook_token'])
+  return redirect(request.args.get('next') or url_for('profile'))
@@ -0,0 +1,104 @@
+from musicroom import shards, jobs, tracks, calls
+import json
+import time
+import uuid
+
+# Each room keeps up to LOOKAHEAD_SIZE resolved songs ready in redis so that
+# /action/play never has to wait on Echo Nest. A refill is queued whenever
+# fewer than REFILL_BELOW are left.
+LOOKAHEAD_SIZE = 5
+REFILL_BELOW = 3
+
+# Only one fill runs per room at a time, under a lock in redis: two at once
+# would both ask the room's Echo Nest session for songs, overfilling the
+# buffer and skipping the songs the session moved past. The lock expires
+# after FILL_LOCK_TTL in case its holder dies; a fill that has to wait gives
+# up after FILL_WAIT.
+FILL_LOCK_TTL = 120
+FILL_WAIT = 20.0
+FILL_POLL_INTERVAL = 0.1
+
+RELEASE_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+  return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
+# The buffer lives in the room's shard's redis.
+def _redis(room_id):
+  return shards.for_room(room_id).redis
+
+def _upcoming_key(room_id):
+  return 'room:%s:upcoming' % room_id
+
+def _queued_key(room_id):
+  return 'room:%s:queued' % room_id
+
+def _filling_key(room_id):
+  return 'room:%s:filling' % room_id
+
+# fill : string, Playlist, boolean -> ()
+# Pulls enough songs from the playlist to top the buffer back up. If another
+# fill is running, waits for it and then tops up whatever it left missing,
+# or with wait=False leaves it to that fill.
+def fill(room_id, pl, wait=True):
+  token = uuid.uuid4().hex
+  deadline = time.time() + FILL_WAIT
+  redis = _redis(room_id)
+  while not redis.set(_filling_key(room_id), token, nx=True, ex=FILL_LOCK_TTL):
+    if not wait or time.time() >= deadline:
+      return
+    time.sleep(FILL_POLL_INTERVAL)
+  try:
+    _fill(room_id, pl)
+  finally:
+    shards.for_room(room_id).script(RELEASE_SCRIPT)(keys=[_filling_key(room_id)], args=[token])
+
+def _fill(room_id, pl):
+  missing = LOOKAHEAD_SIZE - _redis(room_id).llen(_upcoming_key(room_id))
+  if missing <= 0:
+    return
+  songs = calls.retrying(pl.get_next_songs, results=str(missing), lookahead='2') or []
+  # The songs after these are known already; resolve them in the same batch
+  # so that the next fill finds them cached.
+  later = pl.get_lookahead_songs() or []
+  resolved = filter(None, tracks.resolve_many(songs + later)[:len(songs)])
+  if resolved:
+    _redis(room_id).rpush(_upcoming_key(room_id), *map(json.dumps, resolved))
+
+# schedule_fill : string -> ()
+def schedule_fill(room_id):
+  jobs.submit('lookahead:' + room_id, _fill_job, room_id)
+
+def _fill_job(progress, room_id):
+  from musicroom.models import Room
+  fill(room_id, Room(room_id).playlist(), wait=False)
+
+# reset : string -> ()
+# forgets everything buffered for a room, e.g. after its playlist restarts
+def reset(room_id):
+  _redis(room_id).delete(_upcoming_key(room_id), _queued_key(room_id))
+
+# pop : string -> (string, string) dict
+# the next buffered song, or None if the buffer is empty. Queues a refill
+# when the buffer runs low.
+def pop(room_id):
+  pipe = _redis(room_id).pipeline()
+  pipe.lpop(_upcoming_key(room_id))
+  pipe.llen(_upcoming_key(room_id))
+  track, remaining = pipe.execute()
+  if remaining < REFILL_BELOW:
+    schedule_fill(room_id)
+  if track is None:
+    return None
+  return json.loads(track)
+
+# queue : string, (string, string) dict -> (string, string) dict
+# records the song that has been handed to the playback page to play next
+# and returns the one it replaces (the song that has just started playing)
+def queue(room_id, track):
+  previous = _redis(room_id).getset(_queued_key(room_id), json.dumps(track))
+  if previous is None:
+    return None
+  return json.loads(previous)
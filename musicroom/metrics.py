@@ -0,0 +1,360 @@
+from musicroom import app
+from musicroom.lazy import PerProcess
+from flask import request
+from redis import StrictRedis
+from redis.client import StrictPipeline
+from rdio import Transport
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+import urllib2
+
+# Every database statement, upstream API call and redis command is timed, both
+# into histograms (totalled across workers in redis every few seconds, and
+# served at /metrics for Prometheus to scrape) and into a breakdown of the
+# request it was made for. The breakdown goes back
+# to the client as a Server-Timing header, and slow requests are logged with
+# the calls that made them slow. All of this is a couple of time.time() calls
+# and a short lock per call, so it stays on.
+
+# Upper bounds (in seconds) of the histogram buckets.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# How many individual calls a request keeps for its slow request log entry.
+MAX_CALLS = 100
+
+# Time spent in these deliberately doesn't count towards a request being slow.
+IDLE = ('wait',)
+
+def _format_labels(names, values, extra=()):
+  pairs = zip(names, values) + list(extra)
+  if not pairs:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (name, unicode(value).replace('\\', '\\\\').replace('"', '\\"'))
+                           for name, value in pairs)
+
+# Series are stored in one redis hash per metric, with the JSON list of a
+# series' label values (plus which of its numbers it is) as the field.
+def _field(labels, part):
+  return json.dumps(list(labels) + [part])
+
+def _parse_field(field):
+  values = json.loads(field)
+  return tuple(values[:-1]), values[-1]
+
+class Counter(object):
+  """Counts in this process since the last flush; the totals are in redis."""
+
+  def __init__(self, name, help, labels):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self._pending = {}
+    self._lock = threading.Lock()
+
+  def inc(self, labels, amount=1):
+    with self._lock:
+      self._pending[labels] = self._pending.get(labels, 0) + amount
+
+  # flush : Pipeline -> ()
+  # adds what has been counted since the last flush to the totals
+  def flush(self, pipe):
+    with self._lock:
+      pending, self._pending = self._pending, {}
+    for labels, amount in pending.iteritems():
+      pipe.hincrby('metrics:' + self.name, _field(labels, 'value'), amount)
+
+  # render : (string, string) dict -> string list
+  # the totals, given the metric's hash
+  def render(self, stored):
+    lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+    for field, value in sorted(stored.iteritems()):
+      labels, part = _parse_field(field)
+      lines.append('%s%s %s' % (self.name, _format_labels(self.labels, labels), value))
+    return lines
+
+class Histogram(object):
+  """Observations in this process since the last flush; the totals are in
+  redis."""
+
+  def __init__(self, name, help, labels, buckets=BUCKETS):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self.buckets = buckets
+    self._pending = {} # labels -> [bucket counts, sum, count]
+    self._lock = threading.Lock()
+
+  def observe(self, labels, value):
+    with self._lock:
+      series = self._pending.get(labels)
+      if series is None:
+        series = self._pending[labels] = [[0] * len(self.buckets), 0.0, 0]
+      counts = series[0]
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          counts[i] += 1
+          break
+      series[1] += value
+      series[2] += 1
+
+  def flush(self, pipe):
+    with self._lock:
+      pending, self._pending = self._pending, {}
+    key = 'metrics:' + self.name
+    for labels, (counts, total, count) in pending.iteritems():
+      for i, n in enumerate(counts):
+        if n:
+          pipe.hincrby(key, _field(labels, i), n)
+      pipe.hincrbyfloat(key, _field(labels, 'sum'), total)
+      pipe.hincrby(key, _field(labels, 'count'), count)
+
+  def render(self, stored):
+    series = {}
+    for field, value in stored.iteritems():
+      labels, part = _parse_field(field)
+      series.setdefault(labels, {})[part] = value
+    lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+    for labels, parts in sorted(series.iteritems()):
+      cumulative = 0
+      for i, bound in enumerate(self.buckets):
+        cumulative += int(parts.get(i, 0))
+        lines.append('%s_bucket%s %d' % (self.name, _format_labels(self.labels, labels, [('le', repr(bound))]), cumulative))
+      count = int(parts.get('count', 0))
+      lines.append('%s_bucket%s %d' % (self.name, _format_labels(self.labels, labels, [('le', '+Inf')]), count))
+      lines.append('%s_sum%s %s' % (self.name, _format_labels(self.labels, labels), parts.get('sum', 0)))
+      lines.append('%s_count%s %d' % (self.name, _format_labels(self.labels, labels), count))
+    return lines
+
+REQUEST_SECONDS = Histogram('musicroom_request_seconds',
+  'Time taken to handle a request.', ('route', 'status'))
+COMPONENT_SECONDS = Histogram('musicroom_request_component_seconds',
+  'Time a request spent in the database, upstream APIs, redis or waiting.', ('route', 'component'))
+CALL_SECONDS = Histogram('musicroom_call_seconds',
+  'Time taken by single database statements, API calls and redis commands.', ('kind', 'name'))
+CACHE_REQUESTS = Counter('musicroom_cache_requests_total',
+  'Cache lookups, by whether they hit.', ('cache', 'result'))
+SLOW_REQUESTS = Counter('musicroom_slow_requests_total',
+  'Requests that took longer than SLOW_REQUEST_SECONDS.', ('route',))
+
+METRICS = (REQUEST_SECONDS, COMPONENT_SECONDS, CALL_SECONDS, CACHE_REQUESTS, SLOW_REQUESTS)
+
+# flush : () -> ()
+# adds everything this process has measured since the last flush to the
+# totals in redis
+def flush():
+  from musicroom import redis
+  pipe = redis.pipeline(transaction=False)
+  for metric in METRICS:
+    metric.flush(pipe)
+  pipe.execute()
+
+def _flush_periodically():
+  while True:
+    time.sleep(app.config['METRICS_FLUSH_INTERVAL'])
+    try:
+      flush()
+    except Exception:
+      app.logger.exception('could not flush metrics')
+
+def _start_flushing():
+  thread = threading.Thread(target=_flush_periodically, name='metrics')
+  thread.daemon = True
+  thread.start()
+  return thread
+
+# Every worker process flushes on its own, once it has handled a request.
+_flusher = PerProcess(_start_flushing)
+
+class Breakdown(object):
+  """What one request spent its time on. Calls made for it on other threads
+  (see calls.concurrently) add to it too, so the parts can add up to more
+  than the whole."""
+
+  def __init__(self):
+    self.started = time.time()
+    self.totals = {} # kind -> [count, seconds]
+    self.calls = []
+    self._lock = threading.Lock()
+
+  def add(self, kind, name, seconds):
+    with self._lock:
+      total = self.totals.get(kind)
+      if total is None:
+        total = self.totals[kind] = [0, 0.0]
+      total[0] += 1
+      total[1] += seconds
+      if len(self.calls) < MAX_CALLS:
+        self.calls.append((kind, name, seconds))
+
+_local = threading.local()
+
+# current : () -> Breakdown
+# the breakdown of the request this thread is working on, if any
+def current():
+  return getattr(_local, 'breakdown', None)
+
+# attach : Breakdown -> ()
+# makes this thread's calls count towards breakdown (None to stop)
+def attach(breakdown):
+  _local.breakdown = breakdown
+
+# record : string, string, float -> ()
+def record(kind, name, seconds):
+  CALL_SECONDS.observe((kind, name), seconds)
+  breakdown = current()
+  if breakdown is not None:
+    breakdown.add(kind, name, seconds)
+
+class timed(object):
+  """with timed('api', 'facebook:me'): ... records how long the block took."""
+
+  def __init__(self, kind, name):
+    self.kind = kind
+    self.name = name
+
+  def __enter__(self):
+    self.started = time.time()
+    return self
+
+  def __exit__(self, *exc_info):
+    record(self.kind, self.name, time.time() - self.started)
+
+# cache : string, boolean -> ()
+def cache(name, hit):
+  CACHE_REQUESTS.inc((name, 'hit' if hit else 'miss'))
+
+# Timed clients
+
+_statement_names = {}
+_TABLE_AFTER = ('from', 'into', 'update', 'table')
+
+# statement_name : string -> string
+# e.g. 'select room' for a query, so that histograms have a series per kind
+# of statement rather than per query
+def statement_name(sql):
+  name = _statement_names.get(sql)
+  if name is None:
+    words = sql.lower().replace('(', ' ').split()
+    name = words[0] if words else 'other'
+    for previous, word in zip(words, words[1:]):
+      if previous in _TABLE_AFTER and word not in ('exists', 'not', 'if'):
+        name += ' ' + word
+        break
+    _statement_names[sql] = name
+  return name
+
+class TimedConnection(sqlite3.Connection):
+  def execute(self, sql, *args):
+    started = time.time()
+    try:
+      return sqlite3.Connection.execute(self, sql, *args)
+    finally:
+      record('db', statement_name(sql), time.time() - started)
+
+  def executemany(self, sql, *args):
+    started = time.time()
+    try:
+      return sqlite3.Connection.executemany(self, sql, *args)
+    finally:
+      record('db', statement_name(sql), time.time() - started)
+
+class TimedPipeline(StrictPipeline):
+  def execute(self, raise_on_error=True):
+    started = time.time()
+    try:
+      return StrictPipeline.execute(self, raise_on_error)
+    finally:
+      record('redis', 'pipeline', time.time() - started)
+
+class TimedRedis(StrictRedis):
+  def execute_command(self, *args, **options):
+    started = time.time()
+    try:
+      return super(TimedRedis, self).execute_command(*args, **options)
+    finally:
+      record('redis', args[0].lower(), time.time() - started)
+
+  def pipeline(self, transaction=True, shard_hint=None):
+    return TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+_RDIO_METHOD = re.compile(r'(?:^|&)method=([^&]*)')
+
+class TimedTransport(Transport):
+  def post(self, url, body, headers):
+    match = _RDIO_METHOD.search(body)
+    started = time.time()
+    try:
+      return Transport.post(self, url, body, headers)
+    finally:
+      record('api', 'rdio:' + (match.group(1) if match else 'oauth'), time.time() - started)
+
+class EchoNestTimer(urllib2.BaseHandler):
+  """Times pyechonest's requests; added to the opener it sends them with."""
+  handler_order = 100 # before errors are raised, so failures are timed too
+
+  def http_request(self, req):
+    req.metrics_started = time.time()
+    return req
+
+  def http_response(self, req, response):
+    method = req.get_selector().split('?', 1)[0].split('/', 3)[-1]
+    record('api', 'echonest:' + method, time.time() - req.metrics_started)
+    return response
+
+# Per request
+
+@app.before_request
+def start_request():
+  _flusher.resource()
+  attach(Breakdown())
+
+@app.after_request
+def finish_request(response):
+  breakdown = current()
+  if breakdown is None:
+    return response
+  attach(None)
+  elapsed = time.time() - breakdown.started
+  route = request.endpoint or 'unknown'
+  REQUEST_SECONDS.observe((route, str(response.status_code)), elapsed)
+
+  timing = []
+  idle = 0.0
+  for kind, (count, seconds) in sorted(breakdown.totals.iteritems()):
+    COMPONENT_SECONDS.observe((route, kind), seconds)
+    timing.append('%s;dur=%.1f' % (kind, seconds * 1000))
+    if kind in IDLE:
+      idle += seconds
+  timing.append('total;dur=%.1f' % (elapsed * 1000))
+  response.headers['Server-Timing'] = ', '.join(timing)
+
+  if elapsed - idle >= app.config['SLOW_REQUEST_SECONDS']:
+    SLOW_REQUESTS.inc((route,))
+    if random.random() < app.config['SLOW_REQUEST_SAMPLE_RATE']:
+      log_slow_request(breakdown, elapsed, response.status_code)
+  return response
+
+def log_slow_request(breakdown, elapsed, status):
+  totals = ', '.join('%s %.1fms (%d)' % (kind, seconds * 1000, count)
+                     for kind, (count, seconds) in sorted(breakdown.totals.iteritems()))
+  slowest = sorted(breakdown.calls, key=lambda call: -call[2])[:10]
+  calls = '\n'.join('  %8.1fms %s %s' % (seconds * 1000, kind, name) for kind, name, seconds in slowest)
+  app.logger.warning('slow request: %s %s -> %d in %.1fms; %s\n%s',
+                     request.method, request.path, status, elapsed * 1000, totals or 'no calls', calls)
+
+# Totals across every worker (on every host sharing the redis).
+@app.route('/metrics')
+def metrics():
+  from musicroom import redis
+  flush()
+  pipe = redis.pipeline(transaction=False)
+  for metric in METRICS:
+    pipe.hgetall('metrics:' + metric.name)
+  lines = []
+  for metric, stored in zip(METRICS, pipe.execute()):
+    lines.extend(metric.render(stored))
+  return app.response_class('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
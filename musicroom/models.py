@@ -1,25 +1,17 @@
-from musicroom import app, facebook
+from musicroom import facebook, redis, jobs, votes, ids, catalogs, roomstate, metrics, shards, lookahead
 from pyechonest import catalog, playlist
 from pyechonest.util import EchoNestAPIError
+import hashlib
+import json
+import re
 import sqlite3
-import random
-import string
-from flask import g
+import time
+import uuid
+from collections import namedtuple
+from flask import g, has_request_context, session
 from flask_oauth import OAuthException
-
-DATABASE = 'musicroom.db'
-
-def connect_db():
-  return sqlite3.connect(DATABASE)
-
-@app.before_request
-def before_request():
-  g.db = connect_db()
-
-@app.teardown_request
-def teardown_request(exception):
-  if hasattr(g, 'db'):
-    g.db.close()
+from musicroom.database import db
+from musicroom.writer import write
 
 class UnauthorizedError(Exception):
   pass
@@ -30,31 +22,190 @@ class APIError(Exception):
 class NonexistentError(Exception):
   pass
 
-class User:
+# Snapshots of a single row, loaded once per object. The column order matches
+# the tables (after utils/migrations) so that `select *` rows can be used as-is.
+UserRow = namedtuple('UserRow', 'fbid name loaded synced_at')
+RoomRow = namedtuple('RoomRow', 'id name findable seed_catalog playlist status '
+                     'owner_fbid cur_song_id cur_rdio_id cur_artist cur_title '
+                     'num_members active_at search_rowid')
+
+# What listing pages need to know about a room, fetched in bulk.
+RoomSummary = namedtuple('RoomSummary', 'id name num_members')
+
+# The member count is kept on the room by joins and leaves.
+ROOM_SUMMARY_COLUMNS = 'R.id, R.name, R.num_members'
+
+# Number of public rooms shown per page of the profile page.
+PUBLIC_PAGE_SIZE = 50
+
+# What room search returns about each room (active_at is in seconds since the
+# epoch).
+RoomListing = namedtuple('RoomListing', 'id name num_members active_at')
+
+# Search results can be sorted by these room columns, largest first.
+SEARCH_SORTS = {'members': 'num_members', 'activity': 'active_at'}
+
+SEARCH_PAGE_SIZE = 20
+
+# identity_map : class -> (string, object) dict
+# Objects constructed during a request are remembered on `g`, so `Room(id)`
+# and `User(fbid)` hand back the same hydrated object for the rest of the
+# request instead of going back to the database. Outside of a request (in
+# background jobs) nothing is remembered.
+def identity_map(cls):
+  if not has_request_context():
+    return {}
+  attr = '_identity_' + cls.__name__.lower()
+  if not hasattr(g, attr):
+    setattr(g, attr, {})
+  return getattr(g, attr)
+
+# Liked artists are written this many rows per write.
+IMPORT_BATCH_SIZE = 500
+
+# A user's liked artists are re-imported when they are seen after this long.
+RESYNC_INTERVAL = 24 * 60 * 60
+
+# Joins and leaves count the member's likes towards the room, and an import
+# of their likes counts the changes towards the rooms they are in. Each takes
+# the user's likes lock (for at most LIKES_LOCK_TTL seconds) so that neither
+# misses nor repeats what the other did.
+LIKES_LOCK_TTL = 30
+LIKES_LOCK_POLL_INTERVAL = 0.05
+
+RELEASE_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+  return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
+def _likes_lock_key(fbid):
+  return 'user:%s:likes-lock' % fbid
+
+# lock_likes : string -> string
+# waits for the user's likes lock and returns the token to release it with
+def lock_likes(fbid):
+  token = uuid.uuid4().hex
+  while not redis.set(_likes_lock_key(fbid), token, nx=True, ex=LIKES_LOCK_TTL):
+    time.sleep(LIKES_LOCK_POLL_INTERVAL)
+  return token
+
+# unlock_likes : string, string -> ()
+def unlock_likes(fbid, token):
+  redis.eval(RELEASE_SCRIPT, 1, _likes_lock_key(fbid), token)
+
+# How long a Facebook token's identity is trusted before asking Facebook again.
+IDENTITY_TTL = 60 * 60
+
+def _identity_key(token):
+  return 'identity:' + hashlib.sha1(token[0]).hexdigest()
+
+# _revoked : response -> boolean
+# Facebook answers a token that has expired or been revoked with an error of
+# type OAuthException (as a 400), rather than flask_oauth's exception, which
+# only means there was no token at all.
+def _revoked(resp):
+  error = resp.data.get('error') if isinstance(resp.data, dict) else None
+  return resp.status == 401 or (isinstance(error, dict) and error.get('type') == 'OAuthException')
+
+# graph_get : string, (string, string), string -> response
+# A graph API GET with the token, timed as `name`. Raises UnauthorizedError
+# (and stops trusting the token's cached identity) if Facebook no longer
+# accepts the token, and APIError for any other failure.
+def graph_get(url, token, name):
+  try:
+    with metrics.timed('api', name):
+      resp = facebook.get(url, token=token)
+  except OAuthException:
+    raise UnauthorizedError()
+  if resp.status != 200:
+    if _revoked(resp):
+      forget_identity(token)
+      raise UnauthorizedError()
+    raise APIError()
+  return resp
+
+# identity : (string, string) -> (string, string)
+# The fbid and name behind a Facebook token. Cached in redis under the token
+# so that every worker can skip the graph 'me' round trip; a new token is a
+# new key, so logging in again never sees a stale identity.
+def identity(token):
+  key = _identity_key(token)
+  cached = redis.get(key)
+  metrics.cache('identity', cached is not None)
+  if cached is not None:
+    return tuple(json.loads(cached))
+
+  me = graph_get('me', token, 'facebook:me')
+  result = (me.data['id'], me.data['name'])
+  redis.set(key, json.dumps(result), ex=IDENTITY_TTL)
+  return result
+
+# forget_identity : (string, string) -> ()
+def forget_identity(token):
+  redis.delete(_identity_key(token))
+
+class User(object):
+  def __new__(cls, fbid=None, name=None):
+    if fbid is None:
+      fbid, name = cls.current_identity()
+    user = identity_map(cls).get(fbid)
+    if user is None:
+      user = object.__new__(cls)
+    return user
+
   def __init__(self, fbid=None, name=None):
+    if hasattr(self, '_row'):
+      return
+
     if fbid is None:
-      try:
-        me = facebook.get('me')
-        if me.status != 200:
-          raise APIError()
-      except OAuthException:
-        raise UnauthorizedError()
-      fbid = me.data['id']
-      name = me.data['name']
+      fbid, name = self.current_identity()
 
     self._fbid = fbid
 
-    cur = g.db.execute('select loaded from user where fbid = ?', (self._fbid,))
+    cur = db().execute('select * from user where fbid = ?', (self._fbid,))
     row = cur.fetchone()
     if row is None:
-      g.db.execute('insert into user values (?, ?, 0);', (self._fbid, name))
-      g.db.commit()
-      loaded = False
+      write(('insert into user (fbid, name, loaded) values (?, ?, 0);', (self._fbid, name)))
+      self._row = UserRow(self._fbid, name, 0, None)
     else:
-      loaded = row[0]
-
-    if not loaded:
-      self.load_artists()
+      self._row = UserRow(*row)
+      if name is not None and name != self._row.name:
+        write(('update user set name = ? where fbid = ?;', (name, self._fbid)))
+        self._row = self._row._replace(name=name)
+    identity_map(User)[self._fbid] = self
+
+    # Only the logged in user's token can read their likes.
+    if has_request_context() and getattr(g, 'me', (None,))[0] == self._fbid:
+      synced_at = self._row.synced_at or 0
+      if not self._row.loaded or synced_at + RESYNC_INTERVAL < time.time():
+        self.schedule_import(session['facebook_token'])
+
+  # from_row : UserRow -> User
+  # the user for a row that has already been read, without touching the
+  # database or Facebook
+  @classmethod
+  def from_row(cls, row):
+    users = identity_map(cls)
+    user = users.get(row.fbid)
+    if user is None:
+      user = object.__new__(cls)
+      user._fbid = row.fbid
+      user._row = row
+      users[row.fbid] = user
+    return user
+
+  # current_identity : () -> (string, string)
+  # the fbid and name of the logged in user, without loading their row
+  @staticmethod
+  def current_identity():
+    if not hasattr(g, 'me'):
+      token = session.get('facebook_token')
+      if token is None:
+        raise UnauthorizedError()
+      g.me = identity(token)
+    return g.me
 
 
   def __eq__(self, other):
@@ -69,120 +220,369 @@ class User:
 
   # name : () -> string
   def name(self):
-    cur = g.db.execute('select name from user where fbid = ?;', (self._fbid,))
-    return cur.fetchone()[0]
+    return self._row.name
 
   # loaded : () -> boolean
   def loaded(self):
-    cur = g.db.execute('select loaded from user where fbid = ?;', (self._fbid,))
-    return cur.fetchone()[0]
+    return self._row.loaded
+
+  # schedule_import : (string, string) -> string
+  # queues a background import of the user's liked artists from Facebook and
+  # returns the job id
+  def schedule_import(self, token):
+    return jobs.submit('artists:' + self._fbid, import_artists, self._fbid, token)
 
   # load_artists : string list -> ()
-  def load_artists(self, artist_fbids=None):
-    g.db.execute('delete from likes_artist where user_fbid = ?;', (self._fbid,))
-    if artist_fbids is None:
-      try:
-        resp = facebook.get('me/music')
-        if resp.status != 200:
-          raise APIError()
-      except OAuthException:
-        raise UnauthorizedError()
-      music = resp.data['data']
-      artists = filter(lambda item: item['category'] == 'Musician/band', music)
-      values = map(lambda item: (self._fbid, item['id']), artists)
-    else: 
-      values = map(lambda artist_fbid: (self._fbid, artist_fbid), artist_fbids)
-    g.db.executemany('insert or ignore into likes_artist values (?, ?);', values)
-    g.db.execute('update user set loaded = 1 where fbid = ?;', (self._fbid,))
-    g.db.commit()
+  # replaces the user's liked artists with the given ones
+  def load_artists(self, artist_fbids):
+    sync_artists(self._fbid, artist_fbids)
+    self._row = self._row._replace(loaded=1, synced_at=int(time.time()))
+
+  # liked_artists : () -> string list
+  def liked_artists(self):
+    cur = db().execute('select artist_fbid from likes_artist where user_fbid = ?;', (self._fbid,))
+    return [row[0] for row in cur]
 
   # join_room : Room -> ()
   def join_room(self, room):
-    g.db.execute('insert into memberof values (?, ?);', (self._fbid, room.id()))
-    g.db.commit()
+    token = lock_likes(self._fbid)
+    try:
+      room.shard().write(
+        ('insert into memberof values (?, ?);', (self._fbid, room.id())),
+        ('update room set num_members = num_members + 1, active_at = ? where id = ?;', (int(time.time()), room.id())),
+        *artist_count_changes(room.id(), self._fbid, self.liked_artists(), 1)
+      )
+    finally:
+      unlock_likes(self._fbid, token)
+    roomstate.members_changed(room.id(), room.num_members())
+    catalogs.schedule_push(room.id())
 
   # in_room : Room -> boolean
   def in_room(self, room):
-    cur = g.db.execute('select * from memberof where user_fbid = ? and room_id = ?', (self._fbid, room.id()))
+    cur = shards.for_room(room.id()).db().execute('select * from memberof where user_fbid = ? and room_id = ?', (self._fbid, room.id()))
     return (cur.fetchone() is not None)
 
   # leave_room : Room -> ()
   def leave_room(self, room):
-    g.db.execute('delete from memberof where user_fbid = ? and room_id = ?;', (self._fbid, room.id()))
-    g.db.commit()
-
-  # owned_rooms : () -> Room list
+    token = lock_likes(self._fbid)
+    try:
+      statements = artist_count_changes(room.id(), self._fbid, self.liked_artists(), -1)
+      # Like the artist counts, the member count only goes down for a member.
+      statements.append(('update room set num_members = num_members - 1, active_at = ? where id = ? and '
+                         'exists (select 1 from memberof where user_fbid = ? and room_id = ?);',
+                         (int(time.time()), room.id(), self._fbid, room.id())))
+      statements.append(('delete from memberof where user_fbid = ? and room_id = ?;', (self._fbid, room.id())))
+      room.shard().write(*statements)
+    finally:
+      unlock_likes(self._fbid, token)
+    votes.withdraw(room.id(), self._fbid)
+    roomstate.members_changed(room.id(), room.num_members())
+    catalogs.schedule_push(room.id())
+
+  # owned_rooms : () -> RoomSummary list
   def owned_rooms(self):
-    cur = g.db.execute('select id from room where owner_fbid = ?', (self._fbid,))
-    return map(lambda row: Room(row[0]), cur)
+    return _room_summaries(
+      'select ' + ROOM_SUMMARY_COLUMNS + ' from room R where R.owner_fbid = ? order by R.id',
+      (self._fbid,)
+    )
 
-  # joined_rooms : () -> Room list
+  # joined_rooms : () -> RoomSummary list
   def joined_rooms(self):
-    cur = g.db.execute('select room_id from memberof where user_fbid = ?', (self._fbid,))
-    return map(lambda row: Room(row[0]), cur)
+    return _room_summaries(
+      'select ' + ROOM_SUMMARY_COLUMNS + ' from memberof J, room R '
+      'where J.user_fbid = ? and R.id = J.room_id order by R.id',
+      (self._fbid,)
+    )
 
+  # like : Room -> ()
   def like(self, room):
-    g.db.execute('insert or replace into rates_song values (?, ?, 1)', (self._fbid, room.id()))
-    g.db.commit()
+    if votes.cast(room.id(), self._fbid, 1):
+      roomstate.votes_changed(room.id())
 
+  # dislike : Room -> ()
   def dislike(self, room):
-    g.db.execute('insert or replace into rates_song values (?, ?, -1)', (self._fbid, room.id()))
-    g.db.commit()
+    if votes.cast(room.id(), self._fbid, -1):
+      roomstate.votes_changed(room.id())
+
+# _across_shards : string, tuple, int, (tuple -> object) -> tuple list
+# The rows a query finds on every shard, in the order given by key (by
+# default, the rows themselves), and only the first `limit` of them if given
+# (so each shard only needs to return that many).
+def _across_shards(query, args, limit=None, key=None):
+  rows = []
+  for shard in shards.every():
+    rows.extend(shard.db().execute(query, args))
+  rows.sort(key=key)
+  if limit is not None:
+    rows = rows[:limit]
+  return rows
+
+def _room_summaries(query, args, limit=None):
+  return map(lambda row: RoomSummary(*row), _across_shards(query, args, limit))
+
+# search_terms : string -> string
+# An FTS5 query matching room names that have words starting with each word
+# of the search, or None if it has no words. Punctuation is dropped, so
+# nothing typed into a search box can be mistaken for query syntax.
+def search_terms(text):
+  words = re.findall(r'\w+', text or '', re.UNICODE)
+  if not words:
+    return None
+  return ' '.join('"%s"*' % word for word in words)
+
+# search_cursor : RoomListing, string -> string
+# where the page after the one ending with listing starts, for Room.search
+def search_cursor(listing, sort):
+  return '%d:%s' % (getattr(listing, SEARCH_SORTS[sort]), listing.id)
+
+# parse_search_cursor : string -> (int, string)
+# raises ValueError for cursors search_cursor didn't make
+def parse_search_cursor(cursor):
+  value, room_id = cursor.split(':', 1)
+  if not room_id:
+    raise ValueError('bad cursor: ' + cursor)
+  return int(value), room_id
+
+# artist_count_changes : string, string, string list, int -> (string, tuple) list
+# The statements that add change (1 or -1) to the room's count of each of
+# the artists, for the member fbid joining, leaving or changing their likes.
+# They do the job of triggers, which can't see across the two databases
+# memberof and likes_artist live in, and only apply while fbid is a member,
+# so a join must insert memberof first and a leave delete it last. A change of
+# likes racing a join can leave a count off; utils/artist_counts.py repairs
+# them.
+def artist_count_changes(room_id, fbid, artist_fbids, change):
+  member = 'exists (select 1 from memberof where user_fbid = ? and room_id = ?)'
+  statements = []
+  for artist_fbid in artist_fbids:
+    if change > 0:
+      statements.append(('insert or ignore into room_artist_count select ?, ?, 0 where ' + member + ';',
+                         (room_id, artist_fbid, fbid, room_id)))
+    statements.append(('update room_artist_count set count = count + ? '
+                       'where room_id = ? and artist_fbid = ? and ' + member + ';',
+                       (change, room_id, artist_fbid, fbid, room_id)))
+  if change < 0 and artist_fbids:
+    statements.append(('delete from room_artist_count where room_id = ? and count <= 0;', (room_id,)))
+  return statements
+
+# liked_artist_pages : (string, string) -> string list generator
+# the ids of the musicians the token's user likes, one graph page at a time
+def liked_artist_pages(token):
+  url = 'me/music'
+  while url:
+    resp = graph_get(url, token, 'facebook:music')
+    music = resp.data['data']
+    artists = filter(lambda item: item['category'] == 'Musician/band', music)
+    yield map(lambda item: item['id'], artists)
+    url = resp.data.get('paging', {}).get('next')
+
+# import_artists : progress, string, (string, string) -> ()
+# Background job that streams every page of a user's likes from Facebook and
+# applies the difference to what is stored.
+def import_artists(progress, fbid, token):
+  artist_fbids = set()
+  for page in liked_artist_pages(token):
+    artist_fbids.update(page)
+    progress(fetched=len(artist_fbids))
+  added, removed = sync_artists(fbid, artist_fbids)
+  return {'added': len(added), 'removed': len(removed)}
+
+def _batches(items, size=IMPORT_BATCH_SIZE):
+  items = list(items)
+  for i in xrange(0, len(items), size):
+    yield items[i:i + size]
+
+# sync_artists : string, string list -> (string set, string set)
+# Makes the user's stored likes equal to artist_fbids by inserting and
+# deleting only the rows that differ, and marks the user as loaded. Returns
+# the added and removed artist ids. Holds the user's likes lock, so a join or
+# leave happens wholly before or after it.
+def sync_artists(fbid, artist_fbids):
+  token = lock_likes(fbid)
+  try:
+    return _sync_artists(fbid, artist_fbids)
+  finally:
+    unlock_likes(fbid, token)
+
+def _sync_artists(fbid, artist_fbids):
+  wanted = set(artist_fbids)
+  cur = db().execute('select artist_fbid from likes_artist where user_fbid = ?;', (fbid,))
+  stored = set(row[0] for row in cur)
+  added = wanted - stored
+  removed = stored - wanted
+
+  for batch in _batches(added):
+    write(*[('insert or ignore into likes_artist values (?, ?);', (fbid, artist_fbid))
+            for artist_fbid in batch])
+  for batch in _batches(removed):
+    write(*[('delete from likes_artist where user_fbid = ? and artist_fbid = ?;', (fbid, artist_fbid))
+            for artist_fbid in batch])
+
+  write(('update user set loaded = 1, synced_at = ? where fbid = ?;', (int(time.time()), fbid)))
+
+  if added or removed:
+    for shard in shards.every():
+      for row in shard.db().execute('select room_id from memberof where user_fbid = ?;', (fbid,)):
+        room_id = row[0]
+        changes = (artist_count_changes(room_id, fbid, added, 1) +
+                   artist_count_changes(room_id, fbid, removed, -1))
+        for batch in _batches(changes):
+          shard.write(*batch)
+        catalogs.schedule_push(room_id)
+  return added, removed
+
+# A new room's insert is retried this many times if the database is busy.
+ROOM_INSERT_ATTEMPTS = 3
+
+# insert_rooms : (string, string, boolean, string, int) list -> ()
+# Inserts (id, name, findable, owner_fbid, active_at) rows, in one transaction per
+# shard. Ids come from ids.next_id() and can't collide, so the only error
+# worth retrying is a busy database; anything else, or running out of
+# attempts, is raised.
+def insert_rooms(rows):
+  by_shard = {}
+  for row in rows:
+    by_shard.setdefault(shards.for_room(row[0]), []).append(
+      ('insert into room (id, name, findable, status, owner_fbid, active_at) values (?, ?, ?, 0, ?, ?);', row))
+  for shard, statements in by_shard.iteritems():
+    for attempt in xrange(ROOM_INSERT_ATTEMPTS):
+      try:
+        shard.write(*statements)
+        break
+      except sqlite3.OperationalError:
+        if attempt == ROOM_INSERT_ATTEMPTS - 1:
+          raise
+        time.sleep(0.05 * 2 ** attempt)
+
+class Room(object):
+  def __new__(cls, id=None, name=None, owner=None, findable=True):
+    room = None
+    if id is not None:
+      room = identity_map(cls).get(id)
+    if room is None:
+      room = object.__new__(cls)
+    return room
 
-class Room:
   def __init__(self, id=None, name=None, owner=None, findable=True):
+    if hasattr(self, '_row'):
+      return
+
     if id is None and (name is None or owner is None or findable is None):
       raise Exception('new room requires a name and owner')
     elif id is None:
-      # Generate random ids until one of them is unused.
-      # This is really really hacky and bad.
-      while True:
-        try:
-          id = ''.join([random.choice(string.letters[:26]) for i in xrange(8)])
-          g.db.execute('insert into room values (?, ?, ?, null, null, 0, ?, null, null, null, null);', (id, name, findable, owner._fbid))
-          g.db.commit()
-        except:
-          continue
-        else:
-          break
+      id = ids.next_id()
+      now = int(time.time())
+      insert_rooms([(id, name, findable, owner.fbid(), now)])
+      row = RoomRow(id, name, findable, None, None, 0, owner.fbid(), None, None, None, None, 0, now, None)
     else:
-      cur = g.db.execute('select * from room where id = ?', (id,))
-      if cur.fetchone() is None:
+      cur = shards.for_room(id).db().execute('select * from room where id = ?', (id,))
+      row = cur.fetchone()
+      if row is None:
         raise NonexistentError()
+      row = RoomRow(*row)
 
     self._id = id
+    self._row = row
+    self._shard = shards.for_room(id)
+    identity_map(Room)[id] = self
+
+  # create_many : (string, User, boolean) list -> Room list
+  # creates a room for every (name, owner, findable), in one transaction per
+  # shard
+  @classmethod
+  def create_many(cls, specs):
+    now = int(time.time())
+    rows = [RoomRow(ids.next_id(), name, findable, None, None, 0, owner.fbid(), None, None, None, None, 0, now, None)
+            for name, owner, findable in specs]
+    insert_rooms([(row.id, row.name, row.findable, row.owner_fbid, row.active_at) for row in rows])
+    rooms = []
+    for row in rows:
+      room = object.__new__(cls)
+      room._id = row.id
+      room._row = row
+      room._shard = shards.for_room(row.id)
+      identity_map(cls)[row.id] = room
+      rooms.append(room)
+    return rooms
 
   def delete(self):
     self.seed_catalog().delete()
-    g.db.execute('delete from memberof where room_id = ?', (self._id,))
-    g.db.execute('delete from rates_song where room_id = ?', (self._id,))
-    g.db.execute('delete from room where id = ?', (self._id,))
-    g.db.commit()
+    self._shard.write(
+      ('delete from memberof where room_id = ?', (self._id,)),
+      ('delete from rates_song where room_id = ?', (self._id,)),
+      ('delete from catalog_item where room_id = ?', (self._id,)),
+      ('delete from room_artist_count where room_id = ?', (self._id,)),
+      ('delete from room where id = ?', (self._id,))
+    )
+    votes.reset(self._id)
+    lookahead.reset(self._id)
+    roomstate.forget(self._id)
+    identity_map(Room).pop(self._id, None)
+
+  # public_rooms : string, int -> RoomSummary list
+  # one page of findable rooms ordered by id, starting after the room id
+  # `after` (keyset pagination, so every page costs the same)
+  @classmethod
+  def public_rooms(cls, after=None, limit=PUBLIC_PAGE_SIZE):
+    return _room_summaries(
+      'select ' + ROOM_SUMMARY_COLUMNS + ' from room R '
+      'where R.findable = 1 and R.id > ? order by R.id limit ?',
+      (after or '', limit),
+      limit
+    )
 
+  # search : string, string, (int, string), int -> RoomListing list
+  # One page of findable rooms whose names match the text (every room if
+  # there is none), sorted by `sort` (see SEARCH_SORTS) and then id, starting
+  # after the (sort value, room id) position `after` (see search_cursor).
+  # Without text the page is read straight off the sort's index; with text
+  # the name index finds the matches first, so a rare word never walks the
+  # whole table.
   @classmethod
-  def public_rooms(cls):
-    cur = g.db.execute('select id from room where findable = 1')
-    return map(lambda row: cls(row[0]), cur)
+  def search(cls, text=None, sort='members', after=None, limit=SEARCH_PAGE_SIZE):
+    column = SEARCH_SORTS[sort]
+    tables = 'room R'
+    conditions = ['R.findable = 1']
+    args = []
+    terms = search_terms(text)
+    if terms is not None:
+      tables = 'room_search S cross join room R'
+      conditions += ['room_search match ?', 'R.id = S.room_id']
+      args.append(terms)
+    if after is not None:
+      value, room_id = after
+      conditions.append('R.%s <= ? and (R.%s < ? or R.id > ?)' % (column, column))
+      args += [value, value, room_id]
+    args.append(limit)
+    rows = _across_shards(
+      'select R.id, R.name, R.num_members, R.active_at from ' + tables +
+      ' where ' + ' and '.join(conditions) + ' order by R.%s desc, R.id limit ?' % column,
+      args,
+      limit,
+      key=lambda row: (-row[RoomListing._fields.index(column)], row[0])
+    )
+    return map(lambda row: RoomListing(*row), rows)
 
   # id : () -> string
   def id(self):
     return self._id
 
+  # shard : () -> Shard
+  def shard(self):
+    return self._shard
+
   # name : () -> string
   def name(self):
-    cur = g.db.execute('select name from room where id = ?', (self._id,))
-    return cur.fetchone()[0]
+    return self._row.name
 
   # name : () -> boolean
   def findable(self):
-    cur = g.db.execute('select findable from room where id = ?', (self._id,))
-    return cur.fetchone()[0]
+    return self._row.findable
 
   # seed_catalog : () -> Catalog
   # if generate, creates a new catalog if it doesn't already exist
   def seed_catalog(self):
-    cur = g.db.execute('select seed_catalog from room where id = ?', (self._id,))
-    result = cur.fetchone()[0]
+    result = self._row.seed_catalog
     if result is not None:
       try:
         return catalog.Catalog(result)
@@ -190,16 +590,19 @@ class Room:
         pass
 
     cat = catalog.Catalog(str(self.id()), 'general')
-    g.db.execute('update room set seed_catalog = ? where id = ?', (cat.id, self._id))
-    g.db.commit()
+    # We can't vouch for what a new catalog holds, so push everything again.
+    self._shard.write(
+      ('update room set seed_catalog = ? where id = ?', (cat.id, self._id)),
+      ('delete from catalog_item where room_id = ?', (self._id,))
+    )
+    self._row = self._row._replace(seed_catalog=cat.id)
     return cat
 
   # playlist : () -> Playlist
   # if generate, creates a new playlist seeded by the seed_catalog (if it
   # exists)
   def playlist(self, generate=False):
-    cur = g.db.execute('select playlist from room where id = ?', (self._id,))
-    result = cur.fetchone()[0]
+    result = self._row.playlist
     if result is not None:
       try:
         print "using existing playlist"
@@ -222,60 +625,88 @@ class Room:
       seed_catalog=cat.id,
       type='catalog-radio'
     )
-    g.db.execute('update room set playlist = ? where id = ?', (pl.session_id, self._id))
-    g.db.commit()
+    self._shard.write(('update room set playlist = ? where id = ?', (pl.session_id, self._id)))
+    self._row = self._row._replace(playlist=pl.session_id)
     return pl
 
   # status : () -> int
   def status(self):
-    cur = g.db.execute('select status from room where id = ?', (self._id,))
-    return cur.fetchone()[0]
+    return self._row.status
+
+  # owner_fbid : () -> string
+  def owner_fbid(self):
+    return self._row.owner_fbid
 
   # name : () -> User
   def owner(self):
-    cur = g.db.execute('select owner_fbid from room where id = ?', (self._id,))
-    return User(cur.fetchone()[0])
-
-  # members : () -> User  list
-  def members(self):
-    cur = g.db.execute('select user_fbid from memberof where room_id = ?', (self._id,))
-    result = []
-    for row in cur:
-      result.append(User(row[0]))
-    return result
+    return User(self._row.owner_fbid)
+
+  # members : string, int -> User list
+  # The room's members ordered by fbid, optionally only the `limit` after the
+  # fbid `after`. The page of fbids comes from the room's shard and the users
+  # from the main database, a batch at a time, so listing a room never writes
+  # anything or talks to Facebook; members whose likes haven't been imported
+  # yet get their import queued on their next visit.
+  def members(self, after=None, limit=None):
+    cur = self._shard.db().execute(
+      'select user_fbid from memberof where room_id = ? and user_fbid > ? order by user_fbid limit ?',
+      (self._id, after or '', -1 if limit is None else limit)
+    )
+    fbids = [row[0] for row in cur]
+    rows = {}
+    for batch in _batches(fbids):
+      cur = db().execute('select * from user where fbid in (%s)' % ', '.join('?' * len(batch)), batch)
+      for row in cur:
+        rows[row[0]] = UserRow(*row)
+    return [User.from_row(rows[fbid]) for fbid in fbids if fbid in rows]
 
   # num_members : () -> int
+  # the member count joins and leaves keep on the room, read afresh (and
+  # kept on the row for get_cur_rating)
   def num_members(self):
-    cur = g.db.execute('select count(user_fbid) from memberof where room_id = ?', (self._id,))
-    return cur.fetchone()[0]
+    cur = self._shard.db().execute('select num_members from room where id = ?', (self._id,))
+    row = cur.fetchone()
+    if row is None:
+      raise NonexistentError()
+    self._row = self._row._replace(num_members=row[0])
+    return row[0]
 
   # artist_counts : () -> (string, int) dict
+  # how many members like each artist, from the room_artist_count table
+  # that joins, leaves and changes of likes keep up to date
   def artist_counts(self):
-    cur = g.db.execute( 'select L.artist_fbid, count(L.user_fbid) from memberof M, likes_artist L '
-                  'where M.room_id = ? and M.user_fbid = L.user_fbid group by L.artist_fbid', (self._id,) )
-    mapping = {}
-    for row in cur:
-      mapping[row[0]] = row[1]
-    return mapping
+    cur = self._shard.db().execute('select artist_fbid, count from room_artist_count where room_id = ?', (self._id,))
+    return dict(cur.fetchall())
 
   def cur_song(self):
-    cur = g.db.execute('select cur_song_id, cur_rdio_id, cur_artist, cur_title from room where id = ?', (self._id,))
-    row = cur.fetchone()
-    return {'song_id': row[0], 'rdio_id': row[1], 'artist': row[2], 'title': row[3]}
+    row = self._row
+    return {'song_id': row.cur_song_id, 'rdio_id': row.cur_rdio_id, 'artist': row.cur_artist, 'title': row.cur_title}
 
   def set_song(self, song):
-    g.db.execute(
-      'update room set cur_song_id = ?, cur_rdio_id = ?, cur_artist = ?, cur_title = ? where id = ?',
-      (song['song_id'], song['rdio_id'], song['artist'], song['title'], self._id)
+    now = int(time.time())
+    self._shard.write((
+      'update room set cur_song_id = ?, cur_rdio_id = ?, cur_artist = ?, cur_title = ?, active_at = ? where id = ?',
+      (song['song_id'], song['rdio_id'], song['artist'], song['title'], now, self._id)
+    ))
+    votes.reset(self._id)
+    self._row = self._row._replace(
+      cur_song_id=song['song_id'],
+      cur_rdio_id=song['rdio_id'],
+      cur_artist=song['artist'],
+      cur_title=song['title'],
+      active_at=now
+    )
+    roomstate.update(
+      self._id,
+      song_id=song['song_id'],
+      rdio_id=song['rdio_id'],
+      artist=song['artist'],
+      title=song['title'],
+      rating=votes.rating(0, 0, 0)
     )
-    g.db.execute('delete from rates_song where room_id = ?', (self._id,))
-    g.db.commit()
 
+  # get_cur_rating : () -> int
+  # from the member count kept on the room's row, as loaded
   def get_cur_rating(self):
-    cur = g.db.execute('select sum(rating) from rates_song where room_id = ? group by room_id', (self._id,))
-    row = cur.fetchone()
-    if row is None:
-      sum_ = 0
-    else:
-      sum_ = row[0]
-    return int(round(((float(sum_) / self.num_members()) + 1) * 5))
+    up, down = votes.tally(self._id)
+    return votes.rating(up, down, self._row.num_members)
@@ -115,3 +115,100 @@ def om(consumer, url, post_params, token=None, method='POST', realm=None, timest
   authorization_params.extend([p for p in params if p[0] in oauth_params])
 
   return 'OAuth ' + (', '.join(['%s="%s"'%p for p in authorization_params]))
+
+
+_OAUTH_PARAMS = frozenset(('oauth_version', 'oauth_timestamp', 'oauth_nonce',
+                           'oauth_signature_method', 'oauth_signature',
+                           'oauth_consumer_key', 'oauth_token'))
+
+def _escape(s):
+  """The same escaping as om(), without the unicode round trip for byte
+  strings that are already ASCII-compatible."""
+  if isinstance(s, unicode):
+    s = s.encode('utf-8')
+  elif not isinstance(s, str):
+    s = unicode(s).encode('utf-8')
+  return urllib.quote(s, safe='~')
+
+class Signer:
+  """Signs many requests for one consumer (and token) faster than om().
+
+  The HMAC key, the escaped method and realm, and every URL's normalized
+  form are worked out once and reused, and parameter names are only escaped
+  the first time they are seen. The headers are byte-for-byte the ones om()
+  would produce for the same timestamp and nonce.
+
+    signer = Signer((consumer_key, consumer_secret), token)
+    auth = signer.sign(url, params)
+  """
+
+  def __init__(self, consumer, token=None, method='POST', realm=None):
+    self.consumer = consumer
+    self.token = token
+    # the consumer secret and token secret make up the HMAC-SHA1 key
+    hmac_key = consumer[1] + '&'
+    if token is not None:
+      hmac_key += token[1]
+    self._hmac = hmac.new(hmac_key, digestmod=hashlib.sha1)
+    self._method = _escape(method.upper())
+    self._realm = _escape(realm) if realm is not None else None
+    self._urls = {}
+    self._names = {}
+    self._static = [('oauth_version', '1.0'),
+                    ('oauth_signature_method', 'HMAC-SHA1'),
+                    ('oauth_consumer_key', consumer[0])]
+    if token is not None:
+      self._static.append(('oauth_token', token[0]))
+
+  def _normalize(self, url):
+    normalized = self._urls.get(url)
+    if normalized is None:
+      scheme, netloc, path, _, query = urlparse.urlparse(url)[:5]
+      # Exclude default port numbers.
+      if scheme == 'http' and netloc[-3:] == ':80':
+        netloc = netloc[:-3]
+      elif scheme == 'https' and netloc[-4:] == ':443':
+        netloc = netloc[:-4]
+      netloc = netloc.lower()
+      normalized = (_escape('%s://%s%s' % (scheme, netloc, path)),
+                    urlparse.parse_qsl(query))
+      self._urls[url] = normalized
+    return normalized
+
+  def _escape_name(self, name):
+    escaped = self._names.get(name)
+    if escaped is None:
+      escaped = self._names[name] = _escape(name)
+    return escaped
+
+  def sign(self, url, post_params, timestamp=None, nonce=None):
+    """The Authorization header for POSTing post_params to url."""
+    escaped_url, query_params = self._normalize(url)
+
+    if isinstance(post_params, list):
+      params = post_params + query_params
+    else:
+      params = post_params.items() + query_params
+    params.extend(self._static)
+    params.append(('oauth_timestamp', timestamp if timestamp is not None else str(int(time.time()))))
+    params.append(('oauth_nonce', nonce if nonce is not None else str(random.randint(0, 1000000))))
+    params.sort()
+
+    escape_name = self._escape_name
+    params = [(escape_name(k), _escape(v)) for k, v in params]
+    normalized_params = '&'.join(['%s=%s' % p for p in params])
+
+    hashed = self._hmac.copy()
+    hashed.update('%s&%s&%s' % (self._method, escaped_url, _escape(normalized_params)))
+    oauth_signature = binascii.b2a_base64(hashed.digest())[:-1]
+
+    authorization_params = [('oauth_signature', oauth_signature)]
+    if self._realm is not None:
+      authorization_params.insert(0, ('realm', self._realm))
+    authorization_params.extend([p for p in params if p[0] in _OAUTH_PARAMS])
+
+    return 'OAuth ' + (', '.join(['%s="%s"' % p for p in authorization_params]))
+
+  def sign_many(self, requests):
+    """Authorization headers for a list of (url, post_params) pairs."""
+    return [self.sign(url, post_params) for url, post_params in requests]
@@ -17,28 +17,103 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from om import om
-import urllib2, urllib
+from om import Signer
+import httplib, socket, threading, urllib2, urllib, urlparse
+from StringIO import StringIO
 from urlparse import parse_qsl
+from concurrent.futures import ThreadPoolExecutor
 try:
   import json
 except ImportError:
   import simplejson as json
 
+class Transport:
+  """POSTs over kept-alive connections, pooled per host.
+
+  Requests time out after `timeout` seconds and are retried up to `retries`
+  times when the connection fails or the server answers with a 5xx. Other
+  error statuses raise urllib2.HTTPError, as urllib2.urlopen would.
+  """
+
+  def __init__(self, timeout=10.0, retries=2, pool_size=8):
+    self.timeout = timeout
+    self.retries = retries
+    self.pool_size = pool_size
+    self.__idle = {}
+    self.__lock = threading.Lock()
+
+  def __checkout(self, scheme, netloc):
+    with self.__lock:
+      idle = self.__idle.get((scheme, netloc))
+      if idle:
+        return idle.pop()
+    if scheme == 'https':
+      return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+    return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+  def __checkin(self, scheme, netloc, conn):
+    with self.__lock:
+      idle = self.__idle.setdefault((scheme, netloc), [])
+      if len(idle) < self.pool_size:
+        idle.append(conn)
+        return
+    conn.close()
+
+  def post(self, url, body, headers):
+    scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+    if query:
+      path += '?' + query
+    headers = dict(headers)
+    headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    attempt = 0
+    while True:
+      conn = self.__checkout(scheme, netloc)
+      try:
+        conn.request('POST', path, body, headers)
+        res = conn.getresponse()
+        data = res.read()
+      except (socket.error, httplib.HTTPException):
+        # Also covers a kept-alive connection the server has since closed.
+        conn.close()
+        if attempt >= self.retries:
+          raise
+        attempt += 1
+        continue
+
+      if res.will_close:
+        conn.close()
+      else:
+        self.__checkin(scheme, netloc, conn)
+
+      if res.status >= 500 and attempt < self.retries:
+        attempt += 1
+        continue
+      if res.status >= 400:
+        raise urllib2.HTTPError(url, res.status, res.reason, res.msg, StringIO(data))
+      return data
+
 class Rdio:
-  def __init__(self, consumer, token=None):
+  def __init__(self, consumer, token=None, transport=None, base_url='http://api.rdio.com/'):
     self.__consumer = consumer
     self.token = token
+    self.transport = transport or Transport()
+    self.base_url = base_url
+    self.__executor = None
+    self.__signer = None
+
+  def __sign(self, url, params):
+    # the signer is rebuilt whenever authentication changes the token
+    if self.__signer is None or self.__signer.token != self.token:
+      self.__signer = Signer(self.__consumer, self.token)
+    return self.__signer.sign(url, params)
 
   def __signed_post(self, url, params):
-    auth = om(self.__consumer, url, params, self.token)
-    req = urllib2.Request(url, urllib.urlencode(params), {'Authorization': auth})
-    res = urllib2.urlopen(req)
-    return res.read()
+    auth = self.__sign(url, params)
+    return self.transport.post(url, urllib.urlencode(params), {'Authorization': auth})
 
   def begin_authentication(self, callback_url):
     # request a request token from the server
-    response = self.__signed_post('http://api.rdio.com/oauth/request_token',
+    response = self.__signed_post(self.base_url + 'oauth/request_token',
       {'oauth_callback': callback_url})
     # parse the response
     parsed = dict(parse_qsl(response))
@@ -49,7 +124,7 @@ class Rdio:
 
   def complete_authentication(self, verifier):
     # request an access token
-    response = self.__signed_post('http://api.rdio.com/oauth/access_token',
+    response = self.__signed_post(self.base_url + 'oauth/access_token',
         {'oauth_verifier': verifier})
     # parse the response
     parsed = dict(parse_qsl(response))
@@ -62,5 +137,12 @@ class Rdio:
     # put the method in the dict
     params['method'] = method
     # call to the server and parse the response
-    return json.loads(self.__signed_post('http://api.rdio.com/1/', params))
+    return json.loads(self.__signed_post(self.base_url + '1/', params))
 
+  def call_many(self, calls):
+    # make several calls at once over the transport's pooled connections,
+    # given as (method, params) pairs; results come back in the same order
+    if self.__executor is None:
+      self.__executor = ThreadPoolExecutor(max_workers=self.transport.pool_size)
+    futures = [self.__executor.submit(self.call, method, params) for method, params in calls]
+    return [future.result() for future in futures]
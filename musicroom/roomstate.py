@@ -0,0 +1,292 @@
+from musicroom import app, shards, votes, metrics
+from musicroom.lazy import PerProcess
+import json
+import threading
+import time
+
+# What listener pages and the realtime relay need to know about a room,
+# cached in a redis hash (one JSON value per field) so they never have to
+# touch SQLite. The models write through to it in the same step as the
+# database and push the change to the room's subscribers. Entries are filled
+# on first read and expire STATE_TTL later, read or not.
+#
+# Every change also bumps the room's version (room:<id>:version), which
+# outlives the cached entry so that clients polling the JSON state can tell
+# whether anything changed since they last looked. Both live in the room's
+# shard's redis.
+STATE_TTL = 60 * 60
+
+# Long polls are woken by the room's 'state' pushes, but still recheck the
+# version this often in case one was missed. MAX_WAIT is the longest a poll
+# may wait.
+RECHECK_INTERVAL = 5.0
+MAX_WAIT = 25.0
+
+# How long a process's subscriber waits before subscribing again after
+# losing its connection.
+RESUBSCRIBE_DELAY = 1.0
+
+FIELDS = ('name', 'findable', 'owner_fbid', 'song_id', 'rdio_id', 'artist',
+          'title', 'num_members', 'rating')
+
+# Fields are only written while the hash exists, so that a write can never
+# leave behind a half-filled entry that looks like a cached room. The version
+# goes up either way.
+UPDATE_SCRIPT = '''
+local version = redis.call('incr', KEYS[2])
+if redis.call('exists', KEYS[1]) == 1 then
+  for i = 1, #ARGV, 2 do
+    redis.call('hset', KEYS[1], ARGV[i], ARGV[i + 1])
+  end
+end
+return version
+'''
+
+# A fill only lands if nothing has bumped the version since it was read
+# (before the database was), so it can never put back what a change that
+# raced it has already replaced.
+FILL_SCRIPT = '''
+if tonumber(redis.call('get', KEYS[2]) or '0') ~= tonumber(ARGV[1]) then
+  return 0
+end
+redis.call('del', KEYS[1])
+for i = 3, #ARGV, 2 do
+  redis.call('hset', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('expire', KEYS[1], tonumber(ARGV[2]))
+return 1
+'''
+
+# Drops the entry (the next read fills it again) and bumps the version.
+INVALIDATE_SCRIPT = '''
+redis.call('del', KEYS[1])
+return redis.call('incr', KEYS[2])
+'''
+
+def _redis(room_id):
+  return shards.for_room(room_id).redis
+
+def _key(room_id):
+  return 'room:%s:state' % room_id
+
+def _version_key(room_id):
+  return 'room:%s:version' % room_id
+
+class RoomState(object):
+  """A cached room, with the read-only accessors of models.Room that the
+  templates use."""
+
+  def __init__(self, room_id, fields, version):
+    self._id = room_id
+    self._fields = fields
+    self._version = version
+
+  def id(self):
+    return self._id
+
+  def name(self):
+    return self._fields['name']
+
+  def findable(self):
+    return self._fields['findable']
+
+  def owner_fbid(self):
+    return self._fields['owner_fbid']
+
+  def cur_song(self):
+    fields = self._fields
+    return {'song_id': fields['song_id'], 'rdio_id': fields['rdio_id'], 'artist': fields['artist'], 'title': fields['title']}
+
+  def num_members(self):
+    return self._fields['num_members']
+
+  def get_cur_rating(self):
+    return self._fields['rating']
+
+  def version(self):
+    return self._version
+
+  def etag(self):
+    return etag(self._id, self._version)
+
+  # as_dict : () -> (string, object) dict
+  def as_dict(self):
+    result = dict(self._fields)
+    result['id'] = self._id
+    result['version'] = self._version
+    return result
+
+# snapshot : Room -> (string, object) dict
+def snapshot(room):
+  song = room.cur_song()
+  num_members = room.num_members()
+  up, down = votes.tally(room.id())
+  return {
+    'name': room.name(),
+    'findable': bool(room.findable()),
+    'owner_fbid': room.owner_fbid(),
+    'song_id': song['song_id'],
+    'rdio_id': song['rdio_id'],
+    'artist': song['artist'],
+    'title': song['title'],
+    'num_members': num_members,
+    'rating': votes.rating(up, down, num_members),
+  }
+
+# load : string -> RoomState
+# The room's cached state, read through to the database on a miss. Raises
+# models.NonexistentError for rooms that don't exist.
+def load(room_id):
+  key = _key(room_id)
+  # Read the entry and its version together; the update script changes both
+  # in one step.
+  pipe = _redis(room_id).pipeline()
+  pipe.hgetall(key)
+  pipe.get(_version_key(room_id))
+  cached, version = pipe.execute()
+  version = int(version or 0)
+  metrics.cache('roomstate', bool(cached))
+  if cached:
+    return RoomState(room_id, dict((name, json.loads(value)) for name, value in cached.iteritems()), version)
+
+  # The version was read before the database, so if a change lands in
+  # between, the fill is dropped and pollers see a newer version than this.
+  from musicroom.models import Room
+  fields = snapshot(Room(room_id))
+  args = [version, STATE_TTL]
+  for name, value in fields.iteritems():
+    args.extend([name, json.dumps(value)])
+  shards.for_room(room_id).script(FILL_SCRIPT)(keys=[key, _version_key(room_id)], args=args)
+  return RoomState(room_id, fields, version)
+
+# etag : string, int -> string
+def etag(room_id, version):
+  return '%s-%d' % (room_id, version)
+
+# cached_version : string -> int
+# the room's current version, or None if its state isn't cached (in which
+# case only load can say whether the room still exists)
+def cached_version(room_id):
+  pipe = _redis(room_id).pipeline()
+  pipe.exists(_key(room_id))
+  pipe.get(_version_key(room_id))
+  cached, version = pipe.execute()
+  if not cached:
+    return None
+  return int(version or 0)
+
+class Waiters(object):
+  """The long polls waiting in this process, by room. One thread per shard
+  subscribes to its pushes and wakes a room's polls when its state
+  changes."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._events = {}
+    self._subscribed = set()
+
+  # add : string, threading.Event -> ()
+  def add(self, room_id, event):
+    shard = shards.for_room(room_id)
+    with self._lock:
+      self._events.setdefault(room_id, set()).add(event)
+      if shard.name not in self._subscribed:
+        self._subscribed.add(shard.name)
+        thread = threading.Thread(target=self._listen, args=(shard,), name='roomstate-' + shard.name)
+        thread.daemon = True
+        thread.start()
+
+  # remove : string, threading.Event -> ()
+  def remove(self, room_id, event):
+    with self._lock:
+      events = self._events.get(room_id, set())
+      events.discard(event)
+      if not events:
+        self._events.pop(room_id, None)
+
+  # wake : string list -> ()
+  def wake(self, room_ids):
+    with self._lock:
+      events = [event for room_id in room_ids for event in self._events.get(room_id, ())]
+    for event in events:
+      event.set()
+
+  def _listen(self, shard):
+    while True:
+      try:
+        pubsub = shard.redis.pubsub()
+        pubsub.subscribe('push')
+        # Anything pushed while we weren't subscribed was missed, so every
+        # poll on the shard rechecks.
+        with self._lock:
+          room_ids = [room_id for room_id in self._events if shards.for_room(room_id) is shard]
+        self.wake(room_ids)
+        for message in pubsub.listen():
+          if message['type'] != 'message':
+            continue
+          event = json.loads(message['data'])
+          if event['name'] == 'state':
+            self.wake([event['room']])
+      except Exception:
+        app.logger.exception('room state subscriber for %r failed', shard)
+      time.sleep(RESUBSCRIBE_DELAY)
+
+_waiters = PerProcess(Waiters)
+
+# wait : string, int, float -> int
+# Blocks until the room's version moves on from version or timeout seconds
+# pass, whichever is first, and returns the version it saw last (see
+# cached_version).
+def wait(room_id, version, timeout):
+  deadline = time.time() + min(timeout, MAX_WAIT)
+  event = threading.Event()
+  waiters = _waiters.resource()
+  waiters.add(room_id, event)
+  try:
+    current = cached_version(room_id)
+    with metrics.timed('wait', 'roomstate'):
+      while current == version and time.time() < deadline:
+        event.wait(min(RECHECK_INTERVAL, deadline - time.time()))
+        event.clear()
+        current = cached_version(room_id)
+  finally:
+    waiters.remove(room_id, event)
+  return current
+
+# update : string, (string, object) dict -> ()
+# Writes changes to the cached entry, if there is one, and bumps the room's
+# version. With no changes it only bumps the version, for when something
+# changed that the entry doesn't hold yet.
+def update(room_id, **changes):
+  args = []
+  for name, value in changes.iteritems():
+    args.extend([name, json.dumps(value)])
+  shard = shards.for_room(room_id)
+  version = shard.script(UPDATE_SCRIPT)(keys=[_key(room_id), _version_key(room_id)], args=args)
+  changes['version'] = int(version)
+  shard.push(room_id, 'state', changes)
+
+# members_changed : string, int -> ()
+# After a join or leave has been written, drops the cached entry rather than
+# adjusting its count: an entry filled from the database after the write
+# already counts the change. Subscribers are told the room's new count
+# (num_members, read after the write) and rating.
+def members_changed(room_id, num_members):
+  shard = shards.for_room(room_id)
+  version = shard.script(INVALIDATE_SCRIPT)(keys=[_key(room_id), _version_key(room_id)])
+  up, down = votes.tally(room_id)
+  shard.push(room_id, 'state', {'num_members': num_members, 'rating': votes.rating(up, down, num_members),
+                                'version': int(version)})
+
+# votes_changed : string -> ()
+def votes_changed(room_id):
+  num_members = _redis(room_id).hget(_key(room_id), 'num_members')
+  if num_members is not None:
+    up, down = votes.tally(room_id)
+    update(room_id, rating=votes.rating(up, down, json.loads(num_members)))
+  else:
+    update(room_id)
+
+# forget : string -> ()
+def forget(room_id):
+  _redis(room_id).delete(_key(room_id), _version_key(room_id))
@@ -0,0 +1,121 @@
+from musicroom import app, redis
+from musicroom.database import Pool, checkout, _pool
+from musicroom.lazy import PerProcess
+from musicroom.metrics import TimedConnection, TimedRedis, timed
+from musicroom.writer import Writer, _writer
+import bisect
+import hashlib
+import json
+import os
+import threading
+
+# Rooms are spread over shards, each a SQLite database for the room's rows
+# (room, memberof, rates_song, catalog_item, room_artist_count) and a redis
+# for its cached state, votes, playback buffer and push events. Users and
+# their likes stay in the main DATABASE. A room's shard is picked by
+# consistent hashing of its id, so adding a shard only moves the rooms that
+# land on it (see utils/rebalance.py).
+
+# Points each shard gets on the ring. More points even out the share of rooms
+# each shard gets.
+REPLICAS = 100
+
+# Keys from URLs arrive as unicode; hashing their UTF-8 (as the realtime
+# relay does) leaves ASCII ids where they were.
+def _hash(key):
+  if isinstance(key, unicode):
+    key = key.encode('utf-8')
+  return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+class Ring(object):
+  """Consistent hashing: every node is placed at REPLICAS points on a circle
+  of hashes, and a key belongs to the first node at or after its hash."""
+
+  def __init__(self, nodes, replicas=REPLICAS):
+    points = sorted((_hash('%s:%d' % (node, i)), node) for node in nodes for i in xrange(replicas))
+    self._hashes = [point for point, node in points]
+    self._nodes = [node for point, node in points]
+
+  # node : string -> string
+  def node(self, key):
+    i = bisect.bisect_left(self._hashes, _hash(key))
+    return self._nodes[i % len(self._nodes)]
+
+class Shard(object):
+  """Where a set of rooms lives. Connections, the writer thread and redis
+  are made on first use in each process, like the main ones."""
+
+  def __init__(self, name, database, redis_url, pool=None, writer=None, redis=None):
+    self.name = name
+    self.database = database
+    self.redis_url = redis_url
+    self._pool = pool or PerProcess(lambda: Pool(database, factory=TimedConnection))
+    self._writer = writer or PerProcess(lambda: Writer(
+      self._pool.resource().connection,
+      batch_size=app.config['WRITE_BATCH_SIZE'],
+      delay=app.config['WRITE_DELAY'],
+      timeout=app.config['WRITE_TIMEOUT']
+    ))
+    self.redis = redis or PerProcess(lambda: TimedRedis.from_url(redis_url))
+    self._scripts = {}
+    self._lock = threading.Lock()
+
+  # db : () -> sqlite3.Connection
+  def db(self):
+    return checkout(self._pool)
+
+  # write : (string, tuple) ... -> ()
+  # like writer.write, through this shard's writer
+  def write(self, *statements):
+    with timed('db', 'write'):
+      self._writer.resource().write(statements)
+
+  # script : string -> Script
+  # the Lua script registered with this shard's redis. Registering loads it
+  # straight away, so it waits for the first call.
+  def script(self, source):
+    with self._lock:
+      if source not in self._scripts:
+        self._scripts[source] = self.redis.register_script(source)
+      return self._scripts[source]
+
+  # push : string, string, object -> ()
+  # tells the room's subscribers (through the realtime relay, which listens
+  # to every shard) about an event
+  def push(self, room_id, name, data):
+    self.redis.publish('push', json.dumps({'room': room_id, 'name': name, 'data': data}))
+
+  def __repr__(self):
+    return '<Shard %s>' % self.name
+
+# A shard on the main database or redis shares its connections and writer;
+# two writers on one file would only queue up behind each other's locks.
+def _open(name, database, redis_url):
+  main_database = os.path.abspath(database) == os.path.abspath(app.config['DATABASE'])
+  return Shard(
+    name, database, redis_url,
+    pool=_pool if main_database else None,
+    writer=_writer if main_database else None,
+    redis=redis if redis_url == app.config['REDIS_URL'] else None
+  )
+
+def _build():
+  configured = app.config['SHARDS']
+  if not configured:
+    configured = {'main': (app.config['DATABASE'], app.config['REDIS_URL'])}
+  shards = dict((name, _open(name, database, redis_url))
+                for name, (database, redis_url) in configured.iteritems())
+  return Ring(sorted(shards)), shards
+
+_shards = PerProcess(_build)
+
+# for_room : string -> Shard
+def for_room(room_id):
+  ring, shards = _shards.resource()
+  return shards[ring.node(room_id)]
+
+# every : () -> Shard list
+# every shard, for the queries that span rooms
+def every():
+  ring, shards = _shards.resource()
+  return [shards[name] for name in sorted(shards)]
@@ -0,0 +1,99 @@
+from musicroom import redis, calls, metrics
+from collections import OrderedDict
+import json
+import threading
+import time
+
+# Resolving an Echo Nest song to an Rdio track is cached in two tiers: a
+# small LRU in each process in front of a shared one in redis. Songs Rdio
+# doesn't have are cached too, as None.
+LOCAL_SIZE = 10000
+LOCAL_TTL = 10 * 60
+REDIS_TTL = 24 * 60 * 60
+
+class LRUCache(object):
+  """A thread-safe least-recently-used cache whose entries expire."""
+
+  def __init__(self, size, ttl):
+    self._size = size
+    self._ttl = ttl
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  # get : string -> (boolean, object)
+  # (True, value) on a hit, (False, None) on a miss
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None:
+        return False, None
+      expires, value = entry
+      if expires < time.time():
+        return False, None
+      self._entries[key] = entry # now the most recently used
+      return True, value
+
+  def put(self, key, value):
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (time.time() + self._ttl, value)
+      while len(self._entries) > self._size:
+        self._entries.popitem(last=False)
+
+  def __len__(self):
+    return len(self._entries)
+
+_local = LRUCache(LOCAL_SIZE, LOCAL_TTL)
+
+def _key(song_id):
+  return 'track:' + song_id
+
+# lookup : Song -> (string, string) dict
+# the song as the playback page needs it, or None if Rdio doesn't have it
+def lookup(song):
+  tracks = calls.retrying(song.get_tracks, 'rdio-US')
+  if not tracks:
+    return None
+  rdio_id = tracks[0]['foreign_id'].split(':')[-1]
+  return {'song_id': song.id, 'rdio_id': rdio_id, 'artist': song.artist_name, 'title': song.title}
+
+# resolve_many : Song list -> (string, string) dict list
+# Resolves the songs in order (None for songs Rdio doesn't have), looking
+# them up in the local tier, then in one redis round trip, and only then
+# asking Echo Nest, about all of the remaining songs at once.
+def resolve_many(songs):
+  results = {}
+  remote = []
+  for song in songs:
+    hit, value = _local.get(song.id)
+    metrics.cache('tracks_local', hit)
+    if hit:
+      results[song.id] = value
+    else:
+      remote.append(song)
+
+  if remote:
+    cached = redis.mget([_key(song.id) for song in remote])
+    misses = []
+    for song, value in zip(remote, cached):
+      metrics.cache('tracks_redis', value is not None)
+      if value is not None:
+        value = json.loads(value)
+        _local.put(song.id, value)
+        results[song.id] = value
+      else:
+        misses.append(song)
+
+    if misses:
+      pipe = redis.pipeline()
+      for song, value in zip(misses, calls.concurrently(lookup, misses)):
+        pipe.set(_key(song.id), json.dumps(value), ex=REDIS_TTL)
+        _local.put(song.id, value)
+        results[song.id] = value
+      pipe.execute()
+
+  return [results[song.id] for song in songs]
+
+# resolve : Song -> (string, string) dict
+def resolve(song):
+  return resolve_many([song])[0]
@@ -1,11 +1,11 @@
 from flask import request, redirect, url_for, session, flash, abort, render_template
 from flask_oauth import OAuthException
 from pyechonest import catalog, playlist
-import time
 import json
 
-from musicroom import app, facebook, rdio_token, redis, domain
-from musicroom.models import APIError, UnauthorizedError, NonexistentError, Room, User
+from musicroom import app, facebook, rdio_token, jobs, lookahead, catalogs, roomstate, calls
+from musicroom.models import APIError, UnauthorizedError, NonexistentError, Room, User, PUBLIC_PAGE_SIZE
+from musicroom.models import SEARCH_SORTS, SEARCH_PAGE_SIZE, search_cursor, parse_search_cursor
 
 BASE_URL = 'http://localhost:5000'
 
@@ -22,12 +22,60 @@ def profile():
   except UnauthorizedError:
     return redirect(url_for('login', next=request.url))
 
+  # Fetch one extra room to find out whether there is another page.
+  public = Room.public_rooms(after=request.args.get('after'), limit=PUBLIC_PAGE_SIZE + 1)
+  if len(public) > PUBLIC_PAGE_SIZE:
+    public = public[:PUBLIC_PAGE_SIZE]
+    next_after = public[-1].id
+  else:
+    next_after = None
+
   return render_template(
     'profile.html',
     user=user,
-    public=Room.public_rooms()
+    public=public,
+    next_after=next_after
   )
 
+# Longest page of search results a client may ask for.
+MAX_SEARCH_PAGE_SIZE = 100
+
+# ?q=<words>&sort=members|activity&after=<cursor>&limit=<n>
+# A page of public rooms as JSON, with the cursor of the next page (null on
+# the last one) to pass back as `after`.
+@app.route('/rooms/search')
+def search():
+  try:
+    User.current_identity()
+  except APIError:
+    abort(500)
+  except UnauthorizedError:
+    abort(401)
+
+  sort = request.args.get('sort', 'members')
+  limit = request.args.get('limit', SEARCH_PAGE_SIZE, type=int)
+  if sort not in SEARCH_SORTS or not 0 < limit <= MAX_SEARCH_PAGE_SIZE:
+    abort(400) # Bad Request
+  after = request.args.get('after')
+  try:
+    after = parse_search_cursor(after) if after else None
+  except ValueError:
+    abort(400)
+
+  # Fetch one extra room to find out whether there is another page.
+  rooms = Room.search(request.args.get('q'), sort, after, limit + 1)
+  next_after = None
+  if len(rooms) > limit:
+    rooms = rooms[:limit]
+    next_after = search_cursor(rooms[-1], sort)
+
+  response = app.response_class(
+    json.dumps({'rooms': [room._asdict() for room in rooms], 'next': next_after}),
+    mimetype='application/json'
+  )
+  response.headers['Cache-Control'] = 'no-cache'
+  return response
+
 @app.route('/room/create')
 def create():
   name = request.args.get('name')
@@ -85,27 +133,60 @@ def room(room_id):
     return redirect(url_for('login', next=request.url))
 
   try:
-    room = Room(room_id)
+    room = roomstate.load(room_id)
   except NonexistentError:
     abort(404)
 
-  return render_template('room.html', room=room, in_room=me.in_room(room), is_owner=(me == room.owner()))
+  return render_template('room.html', room=room, in_room=me.in_room(room), is_owner=(me.fbid() == room.owner_fbid()))
 
 @app.route('/room/<room_id>/listen')
 def listen(room_id):
   try:
-    room = Room(room_id)
+    room = roomstate.load(room_id)
   except NonexistentError:
     abort(404)
 
+  # Listeners only need to be logged in, which the identity cache can vouch
+  # for without loading their row.
   try:
-    me = User()
+    User.current_identity()
   except APIError:
     abort(500)
   except UnauthorizedError:
     return redirect(url_for('login', next=request.url))
 
-  return render_template('listen.html', domain=domain, room=room)
+  return render_template('listen.html', domain=app.config['DOMAIN'], room=room)
+
+@app.route('/room/<room_id>/state')
+def state(room_id):
+  try:
+    User.current_identity()
+  except APIError:
+    abort(500)
+  except UnauthorizedError:
+    abort(401)
+
+  # A client that already has the current version gets a bodiless 304, and
+  # with ?wait=<seconds> it is held until there is a new version to send.
+  version = roomstate.cached_version(room_id)
+  if version is not None and request.if_none_match.contains(roomstate.etag(room_id, version)):
+    wait = request.args.get('wait', 0, type=float)
+    if wait > 0:
+      version = roomstate.wait(room_id, version, wait)
+    if version is not None and request.if_none_match.contains(roomstate.etag(room_id, version)):
+      response = app.response_class(status=304)
+      response.set_etag(roomstate.etag(room_id, version))
+      return response
+
+  try:
+    room = roomstate.load(room_id)
+  except NonexistentError:
+    abort(404)
+
+  response = app.response_class(json.dumps(room.as_dict()), mimetype='application/json')
+  response.set_etag(room.etag())
+  response.headers['Cache-Control'] = 'no-cache'
+  return response
 
 @app.route('/room/<room_id>/join')
 def join(room_id):
@@ -182,27 +263,40 @@ def start(room_id):
   except UnauthorizedError:
     return redirect(url_for('login', next=request.url))
 
-  liked_artists = room.artist_counts()
-  updater = []
-  for artist in liked_artists:
-    count = liked_artists[artist]
-    item = {'item': {'item_id': artist, 'artist_id': 'facebook:artist:' + artist, 'play_count': count}}
-    updater.append(item)
-
-  cat = room.seed_catalog()
-  ticket = cat.update(updater)
-  while True:
-    status = cat.status(ticket)
-    if status['ticket_status'] == 'complete':
-      break
-    time.sleep(0.1)
+  job_id = jobs.submit('start:' + room_id, start_room, room_id)
+  return json.dumps({'job': job_id, 'status_url': url_for('job_status', job_id=job_id)})
+
+# start_room : progress, string -> (string, string) dict
+# Makes sure the room's seed catalog is up to date (joins and leaves normally
+# keep it so already), then returns the first song of the regenerated
+# playlist. Runs as a background job.
+def start_room(progress, room_id):
+  room = Room(room_id)
+
+  catalogs.push(room, progress)
 
   pl = room.playlist(generate=True)
-  pl.get_next_songs(results='0', lookahead='1')
-  song = pl.get_lookahead_songs()[0]
-  track = song.get_tracks('rdio-US')[0]
-  rdio_id = track['foreign_id'].split(':')[-1]
-  return json.dumps({'song_id': song.id, 'rdio_id': rdio_id, 'artist': song.artist_name, 'title': song.title})
+  lookahead.reset(room_id)
+  lookahead.fill(room_id, pl)
+  first = lookahead.pop(room_id)
+  if first is None:
+    raise APIError('no playable songs for room ' + room_id)
+  lookahead.queue(room_id, first)
+  return first
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+  try:
+    User.current_identity()
+  except APIError:
+    abort(500)
+  except UnauthorizedError:
+    abort(401)
+
+  status = jobs.status(job_id)
+  if status is None:
+    abort(404)
+  return json.dumps(status)
 
 @app.route('/room/<room_id>/action/play')
 def play(room_id):
@@ -218,36 +312,47 @@ def play(room_id):
   except UnauthorizedError:
     return redirect(url_for('login', next=request.url))
 
-  pl = room.playlist()
-
-  pl.get_next_songs(results='0', lookahead='1')
-  cur_song = pl.get_lookahead_songs()[0]
-  cur_track = cur_song.get_tracks('rdio-US')[0]
-  cur_rdio_id = cur_track['foreign_id'].split(':')[-1]
-  current = {
-    'song_id': cur_song.id,
-    'rdio_id': cur_rdio_id,
-    'artist': cur_song.artist_name,
-    'title': cur_song.title
-  }
-
-  if room.cur_song()['song_id'] is not None and room.num_members() > 0:
-    pl.feedback(rate_song='last^'+str(room.get_cur_rating()))
-  pl.feedback(play_song=current['song_id'])
+  upcoming = next_track(room)
+  current = lookahead.queue(room_id, upcoming)
+  if current is None:
+    # Nothing was queued (the room was never started); play what we just got.
+    current = upcoming
+    upcoming = next_track(room)
+    lookahead.queue(room_id, upcoming)
+
+  previous_id = room.cur_song()['song_id']
+  rating = None
+  if previous_id is not None and room.num_members() > 0:
+    rating = room.get_cur_rating()
+  # Feedback doesn't change what we play next, so don't wait for it.
+  calls.background(send_feedback, room_id, previous_id, rating, current['song_id'])
 
   room.set_song(current)
-  redis.publish('push', json.dumps({'room': room_id, 'name': 'playing', 'data': current}))
-
-  pl.get_next_songs(results='0', lookahead='1')
-  next_song = pl.get_lookahead_songs()[0]
-  next_track = next_song.get_tracks('rdio-US')[0]
-  next_rdio_id = next_track['foreign_id'].split(':')[-1]
-  return json.dumps({
-    'song_id': next_song.id,
-    'rdio_id': next_rdio_id,
-    'artist': next_song.artist_name,
-    'title': next_song.title
-  })
+  room.shard().push(room_id, 'playing', current)
+
+  return json.dumps(upcoming)
+
+# next_track : Room -> (string, string) dict
+# the next song from the room's lookahead buffer, filling it inline only if
+# a background refill hasn't caught up (waiting for one that is running)
+def next_track(room):
+  track = lookahead.pop(room.id())
+  if track is None:
+    lookahead.fill(room.id(), room.playlist())
+    track = lookahead.pop(room.id())
+    if track is None:
+      abort(503) # Service Unavailable
+  return track
+
+# send_feedback : string, string, int, string -> ()
+# Tells Echo Nest how the last song was rated and what is playing now. The
+# buffer runs ahead of playback, so songs are rated by id, not as 'last'.
+# Each post is retried on its own so that a retry never repeats the other.
+def send_feedback(room_id, rated_song_id, rating, played_song_id):
+  pl = Room(room_id).playlist()
+  if rating is not None:
+    calls.retrying(pl.feedback, rate_song='%s^%d' % (rated_song_id, rating))
+  calls.retrying(pl.feedback, play_song=played_song_id)
 
 @app.route('/room/<room_id>/action/like')
 def like(room_id):
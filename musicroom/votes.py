@@ -0,0 +1,91 @@
+from musicroom import shards
+
+# Live votes on a room's current song. Each room has a hash of fbid -> vote
+# and a hash of up/down counters, kept in step by a script so that a change
+# of mind moves one vote between the counters atomically.
+
+CAST_SCRIPT = '''
+local previous = redis.call('hget', KEYS[1], ARGV[1])
+if previous == ARGV[2] then
+  return 0
+end
+redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+if previous == '1' then
+  redis.call('hincrby', KEYS[2], 'up', -1)
+elseif previous == '-1' then
+  redis.call('hincrby', KEYS[2], 'down', -1)
+end
+if ARGV[2] == '1' then
+  redis.call('hincrby', KEYS[2], 'up', 1)
+else
+  redis.call('hincrby', KEYS[2], 'down', 1)
+end
+return 1
+'''
+
+# Takes back fbid's vote, if any, and its count.
+WITHDRAW_SCRIPT = '''
+local previous = redis.call('hget', KEYS[1], ARGV[1])
+if not previous then
+  return 0
+end
+redis.call('hdel', KEYS[1], ARGV[1])
+if previous == '1' then
+  redis.call('hincrby', KEYS[2], 'up', -1)
+else
+  redis.call('hincrby', KEYS[2], 'down', -1)
+end
+return 1
+'''
+
+# Votes live in the room's shard's redis.
+def _redis(room_id):
+  return shards.for_room(room_id).redis
+
+def _votes_key(room_id):
+  return 'room:%s:votes' % room_id
+
+def _tally_key(room_id):
+  return 'room:%s:tally' % room_id
+
+# cast : string, string, int -> boolean
+# records fbid's vote (1 or -1) on the room's current song; False if it
+# didn't change anything
+def cast(room_id, fbid, vote):
+  cast = shards.for_room(room_id).script(CAST_SCRIPT)
+  return bool(cast(keys=[_votes_key(room_id), _tally_key(room_id)], args=[fbid, vote]))
+
+# withdraw : string, string -> boolean
+# forgets fbid's vote on the room's current song, e.g. when they leave the
+# room; False if they hadn't voted
+def withdraw(room_id, fbid):
+  withdraw = shards.for_room(room_id).script(WITHDRAW_SCRIPT)
+  return bool(withdraw(keys=[_votes_key(room_id), _tally_key(room_id)], args=[fbid]))
+
+# tally : string -> (int, int)
+# the number of up and down votes on the room's current song
+def tally(room_id):
+  up, down = _redis(room_id).hmget(_tally_key(room_id), 'up', 'down')
+  return int(up or 0), int(down or 0)
+
+# vote_of : string, string -> int
+# fbid's vote on the room's current song, or None
+def vote_of(room_id, fbid):
+  vote = _redis(room_id).hget(_votes_key(room_id), fbid)
+  if vote is None:
+    return None
+  return int(vote)
+
+# rating : int, int, int -> int
+# a song's rating from 0 (everyone disliked it) to 10 (everyone liked it),
+# with members who haven't voted counting as neutral. Kept in range should
+# the count of members lag behind the votes.
+def rating(up, down, num_members):
+  if num_members == 0:
+    return 5
+  return max(0, min(10, int(round(((float(up - down) / num_members) + 1) * 5))))
+
+# reset : string -> ()
+# clears every vote in the room, e.g. when the song changes
+def reset(room_id):
+  _redis(room_id).delete(_votes_key(room_id), _tally_key(room_id))
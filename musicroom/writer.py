@@ -0,0 +1,174 @@
+from musicroom import app
+from musicroom.database import pool
+from musicroom.lazy import PerProcess
+from musicroom.metrics import timed
+import Queue
+import sqlite3
+import threading
+import time
+
+# How often the watchdog looks for writes that have waited too long.
+WATCH_INTERVAL = 1.0
+
+class _Write(object):
+  __slots__ = ('statements', 'done', 'error', 'deadline')
+
+  def __init__(self, statements, deadline):
+    self.statements = statements
+    self.done = threading.Event()
+    self.error = None
+    self.deadline = deadline
+
+class Writer(object):
+  """Group commit for model mutations.
+
+  Writes from every thread are handed to one writer thread, which applies
+  everything that queued up while it was busy (up to `batch_size` writes,
+  optionally waiting `delay` seconds for more) in a single transaction, so a
+  burst of user actions costs one fsync and one trip through SQLite's write
+  lock. With WAL and synchronous = normal a commit costs little, so there it
+  mostly keeps a process to one connection contending for the write lock
+  (with the others' processes) and is about even with committing directly;
+  it pays off when commits are durable (see utils/bench_writes.py). Each
+  write runs in its own savepoint, so a failing write doesn't take the rest
+  of the batch with it. write() blocks until its transaction has committed,
+  which means the caller always reads its own writes.
+
+  Whatever goes wrong with a write (or with opening the connection) is
+  handed back to that write's caller and the thread carries on; should the
+  thread die anyway, the next write starts another. Callers never wait much
+  more than `timeout` seconds: they block until woken (Python 2's timed
+  waits poll, which would add milliseconds to every write), and a watchdog
+  thread wakes the ones whose time is up.
+  """
+
+  def __init__(self, connection, batch_size=100, delay=0.0, timeout=30.0):
+    self._connection = connection
+    self._batch_size = batch_size
+    self._delay = delay
+    self._timeout = timeout
+    self._queue = Queue.Queue()
+    self._lock = threading.Lock()
+    self._thread = None
+    self._watchdog = None
+    self._waiting_lock = threading.Lock()
+    self._waiting = set()
+
+  # write : (string, tuple) list -> ()
+  # Applies the statements atomically, raising the error if they fail. A
+  # write that hasn't committed within the timeout raises
+  # sqlite3.OperationalError (like a database that stayed locked), though it
+  # may still be applied later.
+  def write(self, statements):
+    if self._thread is None or not self._thread.is_alive():
+      self._start()
+    item = _Write(statements, time.time() + self._timeout)
+    with self._waiting_lock:
+      self._waiting.add(item)
+    self._queue.put(item)
+    item.done.wait()
+    with self._waiting_lock:
+      self._waiting.discard(item)
+    if item.error is not None:
+      raise item.error
+
+  def _start(self):
+    with self._lock:
+      if self._thread is None or not self._thread.is_alive():
+        thread = threading.Thread(target=self._run, name='musicroom-writer')
+        thread.daemon = True
+        thread.start()
+        self._thread = thread
+      if self._watchdog is None:
+        watchdog = threading.Thread(target=self._watch, name='musicroom-writer-watchdog')
+        watchdog.daemon = True
+        watchdog.start()
+        self._watchdog = watchdog
+
+  def _watch(self):
+    while True:
+      time.sleep(min(WATCH_INTERVAL, self._timeout))
+      now = time.time()
+      with self._waiting_lock:
+        late = [item for item in self._waiting if item.deadline <= now]
+      for item in late:
+        if not item.done.is_set():
+          item.error = sqlite3.OperationalError('write not committed after %.1fs' % self._timeout)
+          item.done.set()
+
+  def _run(self):
+    conn = None
+    while True:
+      batch = [self._queue.get()]
+      deadline = time.time() + self._delay
+      while len(batch) < self._batch_size:
+        # Everything that queued up during the last commit goes in at once;
+        # after that, wait out the rest of the delay for stragglers.
+        remaining = deadline - time.time()
+        try:
+          if remaining > 0:
+            batch.append(self._queue.get(timeout=remaining))
+          else:
+            batch.append(self._queue.get_nowait())
+        except Queue.Empty:
+          break
+      if conn is None:
+        try:
+          conn = self._connection()
+          conn.isolation_level = None # we issue begin/commit ourselves
+        except Exception as e:
+          # Fail this batch and try again with the next one.
+          conn = None
+          self._finish(batch, e)
+          continue
+      self._commit(conn, batch)
+
+  def _commit(self, conn, batch):
+    try:
+      conn.execute('begin immediate')
+      for item in batch:
+        conn.execute('savepoint write')
+        try:
+          for sql, params in item.statements:
+            conn.execute(sql, params)
+        except Exception as e:
+          # Database errors and malformed statements alike.
+          conn.execute('rollback to write')
+          item.error = e
+        conn.execute('release write')
+      conn.execute('commit')
+    except Exception as e:
+      # The transaction as a whole failed, e.g. the database stayed locked.
+      try:
+        conn.execute('rollback')
+      except sqlite3.Error:
+        pass
+      self._finish(batch, e)
+      return
+    self._finish(batch)
+
+  # _finish : _Write list, Exception -> ()
+  # wakes the batch's callers, failing those without an error of their own
+  # with the given one
+  def _finish(self, batch, error=None):
+    for item in batch:
+      if item.error is None:
+        item.error = error
+      item.done.set()
+
+# The writer's thread doesn't survive a fork, so each process starts its own.
+_writer = PerProcess(lambda: Writer(
+  pool().connection,
+  batch_size=app.config['WRITE_BATCH_SIZE'],
+  delay=app.config['WRITE_DELAY'],
+  timeout=app.config['WRITE_TIMEOUT']
+))
+def writer():
+  return _writer.resource()
+
+# write : (string, tuple) ... -> ()
+# e.g. write(('delete from memberof where room_id = ?', (room_id,)),
+#            ('delete from room where id = ?', (room_id,)))
+def write(*statements):
+  with timed('db', 'write'):
+    writer().write(statements)
@@ -1,22 +1,114 @@
 var io = require('socket.io').listen(8001);
 var redis = require('redis');
+var crypto = require('crypto');
+var url = require('url');
 
-var sub = redis.createClient();
+// Rooms publish their pushes and keep their state in their shard's redis
+// (see musicroom/shards.py), so listen to every shard. MUSICROOM_SHARDS is
+// the same JSON the web app reads; without it everything is in one redis.
+function redisUrls() {
+  var shards = JSON.parse(process.env.MUSICROOM_SHARDS || '{}');
+  var urls = {};
+  for (var name in shards) {
+    urls[name] = shards[name][1];
+  }
+  if (Object.keys(urls).length === 0) {
+    urls.main = process.env.MUSICROOM_REDIS_URL || 'redis://localhost:6379/0';
+  }
+  return urls;
+}
+
+// The web app's consistent hash ring (shards.Ring), to find a room's shard.
+var REPLICAS = 100;
+
+function hash(key) {
+  return parseInt(crypto.createHash('md5').update(key, 'utf8').digest('hex').slice(0, 8), 16);
+}
+
+function Ring(nodes) {
+  var points = [];
+  nodes.forEach(function (node) {
+    for (var i = 0; i < REPLICAS; i++) {
+      points.push([hash(node + ':' + i), node]);
+    }
+  });
+  points.sort(function (a, b) {
+    return a[0] - b[0] || (a[1] < b[1] ? -1 : a[1] > b[1] ? 1 : 0);
+  });
+  this.hashes = points.map(function (point) { return point[0]; });
+  this.nodes = points.map(function (point) { return point[1]; });
+}
+
+// the first node at or after the key's hash
+Ring.prototype.node = function (key) {
+  var h = hash(key), lo = 0, hi = this.hashes.length;
+  while (lo < hi) {
+    var mid = (lo + hi) >> 1;
+    if (this.hashes[mid] < h) {
+      lo = mid + 1;
+    } else {
+      hi = mid;
+    }
+  }
+  return this.nodes[lo % this.nodes.length];
+};
+
+function connect(redisUrl) {
+  var parsed = url.parse(redisUrl);
+  var client = redis.createClient(parseInt(parsed.port || '6379', 10), parsed.hostname);
+  var db = parseInt((parsed.pathname || '/0').slice(1) || '0', 10);
+  if (db) {
+    client.select(db);
+  }
+  return client;
+}
+
+var urls = redisUrls();
+var ring = new Ring(Object.keys(urls).sort());
+var stores = {};
 
-sub.on('message', function (channel, message) {
-  message_obj = JSON.parse(message);
-  if (message_obj.room && message_obj.name) {
-    io.sockets.in(message_obj.room).emit(
-      message_obj.name,
-      message_obj.data
-    );
+// One subscriber and one client for reads per redis, however many shards
+// share it.
+var byUrl = {};
+Object.keys(urls).forEach(function (name) {
+  var redisUrl = urls[name];
+  if (byUrl[redisUrl]) {
+    stores[name] = byUrl[redisUrl];
+    return;
   }
+  var sub = connect(redisUrl);
+  sub.on('message', function (channel, message) {
+    message_obj = JSON.parse(message);
+    if (message_obj.room && message_obj.name) {
+      io.sockets.in(message_obj.room).emit(
+        message_obj.name,
+        message_obj.data
+      );
+    }
+  });
+  sub.subscribe("push");
+  stores[name] = byUrl[redisUrl] = connect(redisUrl);
 });
 
 io.sockets.on('connection', function (socket) {
   socket.on('subscribe', function (data) {
     if (data.room) {
       socket.join(data.room);
+
+      // Catch the new subscriber up from the room state cache the web app
+      // keeps (see musicroom/roomstate.py); later changes arrive as 'state'
+      // pushes. Only the room's own shard has it.
+      var store = stores[ring.node(data.room)];
+      store.hgetall('room:' + data.room + ':state', function (err, fields) {
+        if (err || !fields) {
+          return;
+        }
+        var state = {id: data.room};
+        for (var name in fields) {
+          state[name] = JSON.parse(fields[name]);
+        }
+        socket.emit('state', state);
+      });
     }
   });
 
@@ -26,5 +118,3 @@ io.sockets.on('connection', function (socket) {
     }
   });
 });
-
-sub.subscribe("push");
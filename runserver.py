@@ -1,5 +1,5 @@
-import musicroom
-from musicroom import app
+from musicroom import create_app
 
-app.debug = True
-app.run(host='0.0.0.0', port=80)
+app = create_app()
+# Threaded, so that long polls on room state don't hold up other requests.
+app.run(host='0.0.0.0', port=80, threaded=True)
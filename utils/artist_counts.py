@@ -0,0 +1,73 @@
+# Checks or repairs room_artist_count, the per-room artist counts that the
+# app keeps in step with memberof and likes_artist.
+#
+#   python utils/artist_counts.py check [musicroom.db] [--users musicroom.db]
+#   python utils/artist_counts.py rebuild [musicroom.db] [room_id ...] [--users musicroom.db]
+#
+# check lists every (room, artist) whose stored count differs from the one
+# computed from scratch and exits non-zero if there are any. rebuild
+# recomputes the given rooms, or every room. For a shard's database (see
+# musicroom/shards.py), --users names the main database the likes are in.
+
+import sqlite3
+import sys
+
+COMPUTED = ('select M.room_id, L.artist_fbid, count(L.user_fbid) from memberof M, %(likes)s L '
+            'where M.user_fbid = L.user_fbid %(where)s group by M.room_id, L.artist_fbid')
+
+# connect : string, string -> sqlite3.Connection
+# the rooms' database, with the users' attached as `users` if they're apart
+def connect(path, users_path=None):
+  conn = sqlite3.connect(path, timeout=30.0)
+  if users_path is not None:
+    conn.execute('attach database ? as users', (users_path,))
+  return conn
+
+def _computed(conn, where=''):
+  attached = any(row[1] == 'users' for row in conn.execute('pragma database_list'))
+  return COMPUTED % {'likes': 'users.likes_artist' if attached else 'likes_artist', 'where': where}
+
+# differences : sqlite3.Connection -> (string, string, int, int) list
+# (room, artist, stored count, computed count) for every count that is off
+def differences(conn):
+  stored = dict(((room, artist), count) for room, artist, count in
+                conn.execute('select room_id, artist_fbid, count from room_artist_count'))
+  computed = dict(((room, artist), count) for room, artist, count in
+                  conn.execute(_computed(conn)))
+  result = []
+  for key in set(stored) | set(computed):
+    if stored.get(key, 0) != computed.get(key, 0):
+      result.append(key + (stored.get(key, 0), computed.get(key, 0)))
+  return sorted(result)
+
+# rebuild : sqlite3.Connection, string list -> ()
+def rebuild(conn, room_ids=None):
+  if room_ids:
+    marks = ', '.join('?' * len(room_ids))
+    conn.execute('delete from room_artist_count where room_id in (%s)' % marks, room_ids)
+    conn.execute('insert into room_artist_count ' + _computed(conn, 'and M.room_id in (%s)' % marks), room_ids)
+  else:
+    conn.execute('delete from room_artist_count')
+    conn.execute('insert into room_artist_count ' + _computed(conn))
+  conn.commit()
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  users_path = None
+  if '--users' in args:
+    i = args.index('--users')
+    users_path = args[i + 1] if i + 1 < len(args) else None
+    del args[i:i + 2]
+  if not args or args[0] not in ('check', 'rebuild') or ('--users' in sys.argv and users_path is None):
+    print "usage: artist_counts.py check|rebuild [musicroom.db] [room_id ...] [--users musicroom.db]"
+    sys.exit(2)
+  conn = connect(args[1] if len(args) > 1 else 'musicroom.db', users_path)
+
+  if args[0] == 'check':
+    diffs = differences(conn)
+    for room, artist, stored, computed in diffs:
+      print "room %s artist %s: stored %d, expected %d" % (room, artist, stored, computed)
+    sys.exit(1 if diffs else 0)
+
+  rebuild(conn, args[2:])
+  print "Rebuilt artist counts for %s" % (', '.join(args[2:]) or 'every room')
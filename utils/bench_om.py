@@ -0,0 +1,61 @@
+# Checks that om.Signer signs exactly like om.om() and compares their speed.
+#
+#   python utils/bench_om.py [iterations]
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'musicroom'))
+
+from om import om, Signer
+
+CONSUMER = ('yjgnkcp2kr8ykwwjtujb5ajv', 'trpsv6n6gm')
+TOKEN = ('token-key', 'token-secret')
+TIMESTAMP = '1372000000'
+NONCE = '424242'
+
+# (url, params, token, realm) covering what the Rdio client sends and the
+# corners of URL normalization and escaping.
+CASES = [
+  ('http://api.rdio.com/1/', {'method': 'getPlaybackToken', 'domain': 'localhost'}, None, None),
+  ('http://api.rdio.com/1/', {'method': 'search', 'query': u'Bj\xf6rk & friends', 'types': 'Track'}, None, None),
+  ('http://api.rdio.com/1/', {'method': 'get', 'keys': 't1,t2,t3', 'count': 10}, TOKEN, None),
+  ('http://API.rdio.com:80/oauth/request_token', {'oauth_callback': 'http://localhost:5000/cb?x=1'}, None, None),
+  ('https://api.rdio.com:443/1/?extra=1&extra=0', [('method', 'get'), ('b', 'x y'), ('a', '~*')], TOKEN, 'rdio'),
+  ('http://api.rdio.com/1/', {}, TOKEN, 'http://realm.example/'),
+]
+
+# check : () -> int
+# the number of cases where Signer and om() disagree
+def check():
+  failures = 0
+  for url, params, token, realm in CASES:
+    expected = om(CONSUMER, url, params, token, realm=realm, timestamp=TIMESTAMP, nonce=NONCE)
+    signer = Signer(CONSUMER, token, realm=realm)
+    for actual in (signer.sign(url, params, timestamp=TIMESTAMP, nonce=NONCE),
+                   signer.sign(url, params, timestamp=TIMESTAMP, nonce=NONCE)):
+      if actual != expected:
+        failures += 1
+        print 'MISMATCH for %s %r' % (url, params)
+        print '  om:     ' + expected
+        print '  Signer: ' + actual
+  return failures
+
+def bench(iterations):
+  url, params = CASES[1][:2]
+  signer = Signer(CONSUMER, TOKEN)
+  one_shot = timeit.timeit(lambda: om(CONSUMER, url, params, TOKEN), number=iterations)
+  reused = timeit.timeit(lambda: signer.sign(url, params), number=iterations)
+  batched = timeit.timeit(lambda: signer.sign_many([(url, params)] * 100), number=iterations / 100)
+  print 'om()            %8.1f us/request' % (one_shot / iterations * 1e6)
+  print 'Signer.sign     %8.1f us/request' % (reused / iterations * 1e6)
+  print 'Signer.sign_many%8.1f us/request' % (batched / iterations * 1e6)
+
+if __name__ == '__main__':
+  iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  failures = check()
+  if failures:
+    sys.exit(1)
+  print 'Signer matches om() on %d cases' % len(CASES)
+  bench(iterations)
@@ -0,0 +1,79 @@
+# Compares model write throughput with a commit per write against the group
+# committing writer in musicroom.writer.
+#
+#   python utils/bench_writes.py [threads] [writes per thread] [--full]
+#
+# Each thread plays a user joining and leaving rooms, which is what a busy
+# room looks like to SQLite. Runs against a scratch database with the app's
+# pragmas, or with synchronous = full (an fsync per commit) given --full.
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from musicroom.database import Pool, PRAGMAS
+from musicroom.writer import Writer
+import migrate
+
+def scratch_database():
+  fd, path = tempfile.mkstemp(suffix='.db')
+  os.close(fd)
+  conn = Pool(path).connection()
+  conn.executescript(open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')).read())
+  migrate.migrate(conn)
+  return path
+
+def statements(thread, writes):
+  for i in xrange(writes):
+    fbid = '%d-%d' % (thread, i)
+    if i % 2 == 0:
+      yield ('insert into memberof values (?, ?);', (fbid, 'room%d' % thread))
+    else:
+      yield ('delete from memberof where user_fbid = ? and room_id = ?;', ('%d-%d' % (thread, i - 1), 'room%d' % thread))
+
+def direct(pool):
+  def run(thread, writes):
+    conn = pool.connection()
+    for sql, params in statements(thread, writes):
+      conn.execute(sql, params)
+      conn.commit()
+  return run
+
+def coalesced(pool):
+  writer = Writer(pool.connection)
+  def run(thread, writes):
+    for statement in statements(thread, writes):
+      writer.write([statement])
+  return run
+
+def measure(name, make_run, threads, writes, pragmas):
+  path = scratch_database()
+  try:
+    run = make_run(Pool(path, pragmas=pragmas, timeout=60.0))
+    workers = [threading.Thread(target=run, args=(t, writes)) for t in xrange(threads)]
+    start = time.time()
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join()
+    elapsed = time.time() - start
+  finally:
+    for suffix in ('', '-wal', '-shm'):
+      if os.path.exists(path + suffix):
+        os.remove(path + suffix)
+  print '%-10s %6d writes in %6.2fs  %8.0f writes/s' % (name, threads * writes, elapsed, threads * writes / elapsed)
+
+if __name__ == '__main__':
+  args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+  threads = int(args[0]) if len(args) > 0 else 16
+  writes = int(args[1]) if len(args) > 1 else 200
+  pragmas = PRAGMAS
+  if '--full' in sys.argv:
+    pragmas = PRAGMAS + ('pragma synchronous = full',)
+  measure('direct', direct, threads, writes, pragmas)
+  measure('coalesced', coalesced, threads, writes, pragmas)
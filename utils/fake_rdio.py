@@ -0,0 +1,52 @@
+# A stand-in for the Rdio web service API, for running musicroom without
+# Rdio. Answers getPlaybackToken with a fixed token and any other method
+# with its own parameters. Keeps connections alive like the real thing.
+#
+#   python utils/fake_rdio.py [port]
+#
+# then point the app at it with app.config['RDIO_URL'] = 'http://localhost:<port>/'
+
+import BaseHTTPServer
+import SocketServer
+import json
+import sys
+from urlparse import parse_qsl
+
+PLAYBACK_TOKEN = 'GAlNi78J_____zlyYWs5ZG02N2pkaHlhcWsyOWJtYjkyN2xvY2FsaG9zdEbwl7EHvbylWSWFWYMZwfc='
+
+class RdioHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def do_POST(self):
+    length = int(self.headers.getheader('Content-Length') or 0)
+    params = dict(parse_qsl(self.rfile.read(length)))
+
+    if self.path != '/1/' or 'Authorization' not in self.headers:
+      self.respond(401, {'status': 'error', 'message': 'not authorized'})
+    elif params.get('method') == 'getPlaybackToken':
+      self.respond(200, {'status': 'ok', 'result': PLAYBACK_TOKEN})
+    else:
+      self.respond(200, {'status': 'ok', 'result': params})
+
+  def respond(self, status, obj):
+    body = json.dumps(obj)
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+class ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+# serve : int -> ThreadedServer
+def serve(port):
+  return ThreadedServer(('localhost', port), RdioHandler)
+
+if __name__ == '__main__':
+  port = int(sys.argv[1]) if len(sys.argv) > 1 else 8002
+  print "Fake Rdio listening on http://localhost:%d/" % port
+  serve(port).serve_forever()
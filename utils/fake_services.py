@@ -0,0 +1,321 @@
+# Stand-ins for the Rdio, Echo Nest and Facebook APIs, for running (and load
+# testing) musicroom without any of them. Each can be made slow or flaky.
+#
+#   python utils/fake_services.py [--latency MS] [--jitter MS] [--errors RATE]
+#                                 [--echonest-latency MS] [--facebook-errors RATE] ...
+#
+# then start the app with MUSICROOM_SETTINGS=utils/fake_settings.py to point
+# it at them. Latency is drawn from a normal distribution around --latency;
+# a fraction --errors of requests fail with a 503 (Echo Nest, Rdio) or 500
+# (Facebook) before reaching the fake.
+#
+# Facebook logs every sign in as a new user who likes a few dozen of a fixed
+# pool of artists. Echo Nest keeps catalogs and playlist sessions in memory
+# and makes up songs by the artists in a session's seed catalog.
+
+import BaseHTTPServer
+import argparse
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+import urllib
+from urlparse import urlparse, parse_qsl
+
+import fake_rdio
+
+PORTS = {'rdio': 8002, 'echonest': 8003, 'facebook': 8004}
+
+class Faults(object):
+  """How slow and how unreliable a fake service is."""
+
+  def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0):
+    self.latency = latency
+    self.jitter = jitter
+    self.error_rate = error_rate
+
+  # delay : () -> float
+  # seconds to hold the next request for
+  def delay(self):
+    return max(0.0, random.gauss(self.latency, self.jitter))
+
+  def fail(self):
+    return random.random() < self.error_rate
+
+class ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  error_status = 503
+
+  # Injected latency and errors happen before the request is handled at all,
+  # the way they would in front of the real thing.
+  def parse_request(self):
+    if not BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self):
+      return False
+    faults = self.server.faults
+    time.sleep(faults.delay())
+    if faults.fail():
+      self.send_error(self.error_status)
+      return False
+    return True
+
+  # params : () -> (string, string) dict
+  # the query string and any form encoded body, together
+  def params(self):
+    url = urlparse(self.path)
+    params = dict(parse_qsl(url.query))
+    length = int(self.headers.getheader('Content-Length') or 0)
+    if length:
+      params.update(parse_qsl(self.rfile.read(length)))
+    return params
+
+  def respond(self, status, obj, headers={}):
+    body = json.dumps(obj)
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    for name, value in headers.iteritems():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+class RdioService(ServiceHandler, fake_rdio.RdioHandler):
+  pass
+
+# Echo Nest
+
+ARTISTS = 2000 # the size of the pool of artists users like
+SONGS_PER_ARTIST = 50
+UNPLAYABLE = 0.1 # the fraction of songs Rdio doesn't have
+
+_ids = itertools.count(1)
+_lock = threading.Lock()
+_catalogs = {} # id -> {'name', 'type', 'items'}
+_sessions = {} # session id -> seed catalog id
+
+def _new_id(prefix):
+  return '%s%016X' % (prefix, next(_ids))
+
+def _song(artist, number, with_tracks):
+  song_id = 'SO%08X%08X' % (int(artist), number)
+  song = {'id': song_id, 'title': 'Song %d' % number, 'artist_name': 'Artist %s' % artist,
+          'artist_id': 'AR%016X' % int(artist)}
+  if with_tracks:
+    song['tracks'] = _tracks(song_id)
+  return song
+
+def _tracks(song_id):
+  if random.Random(song_id).random() < UNPLAYABLE:
+    return []
+  return [{'catalog': 'rdio-US', 'foreign_id': 'rdio-US:track:t' + song_id[2:], 'id': 'TR' + song_id[2:]}]
+
+class EchoNestService(ServiceHandler):
+
+  def do_GET(self):
+    self.dispatch()
+
+  def do_POST(self):
+    self.dispatch()
+
+  def dispatch(self):
+    path = urlparse(self.path).path
+    prefix = '/api/v4/'
+    method = getattr(self, 'api_' + path[len(prefix):].replace('/', '_'), None)
+    if not path.startswith(prefix) or method is None:
+      return self.error(4, 'unknown method ' + path)
+    params = self.params()
+    if 'api_key' not in params:
+      return self.error(1, 'missing api_key')
+    with _lock:
+      result = method(params)
+    if result is not None:
+      result['status'] = {'code': 0, 'message': 'Success', 'version': '4.2'}
+      self.respond(200, {'response': result})
+
+  def error(self, code, message):
+    self.respond(400, {'response': {'status': {'code': code, 'message': message, 'version': '4.2'}}})
+
+  def api_catalog_profile(self, params):
+    for catalog_id, cat in _catalogs.iteritems():
+      if catalog_id == params.get('id') or cat['name'] == params.get('name'):
+        return {'catalog': {'id': catalog_id, 'name': cat['name'], 'type': cat['type'], 'total': len(cat['items'])}}
+    self.error(5, 'no such catalog')
+
+  def api_catalog_create(self, params):
+    catalog_id = _new_id('CA')
+    _catalogs[catalog_id] = {'name': params['name'], 'type': params['type'], 'items': {}}
+    return {'id': catalog_id, 'name': params['name'], 'type': params['type']}
+
+  def api_catalog_update(self, params):
+    cat = _catalogs.get(params.get('id')) or self.by_name(params.get('name'))
+    if cat is None:
+      return self.error(5, 'no such catalog')
+    for update in json.loads(params['data']):
+      item = update['item']
+      if update['action'] == 'delete':
+        cat['items'].pop(item['item_id'], None)
+      else:
+        cat['items'][item['item_id']] = item
+    return {'ticket': _new_id('')}
+
+  def api_catalog_status(self, params):
+    return {'ticket_status': 'complete', 'percent_complete': 100}
+
+  def api_catalog_delete(self, params):
+    catalog_id = params.get('id')
+    if _catalogs.pop(catalog_id, None) is None:
+      return self.error(5, 'no such catalog')
+    return {'id': catalog_id}
+
+  def api_catalog_list(self, params):
+    catalogs = [{'id': catalog_id, 'name': cat['name'], 'type': cat['type']} for catalog_id, cat in _catalogs.iteritems()]
+    return {'catalogs': catalogs, 'total': len(catalogs), 'start': 0}
+
+  def by_name(self, name):
+    for cat in _catalogs.itervalues():
+      if cat['name'] == name:
+        return cat
+    return None
+
+  def api_playlist_dynamic_create(self, params):
+    if params.get('seed_catalog') not in _catalogs:
+      return self.error(5, 'no such catalog')
+    session_id = _new_id('').lower()
+    _sessions[session_id] = params['seed_catalog']
+    return {'session_id': session_id}
+
+  def api_playlist_dynamic_restart(self, params):
+    if params.get('session_id') not in _sessions:
+      return self.error(5, 'no such session')
+    _sessions[params['session_id']] = params.get('seed_catalog', _sessions[params['session_id']])
+    return {'session_id': params['session_id']}
+
+  # Songs come back with their tracks, as asked for by the app's buckets;
+  # lookahead songs don't, so looking them up costs a song/profile call.
+  def api_playlist_dynamic_next(self, params):
+    cat = _catalogs.get(_sessions.get(params.get('session_id')))
+    if cat is None:
+      return self.error(5, 'no such session')
+    artists = [item['item_id'] for item in cat['items'].itervalues()] or ['1']
+    pick = lambda: (random.choice(artists), random.randint(1, SONGS_PER_ARTIST))
+    songs = [_song(artist, number, True) for artist, number in
+             [pick() for i in xrange(int(params.get('results') or 1))]]
+    lookahead = [_song(artist, number, False) for artist, number in
+                 [pick() for i in xrange(int(params.get('lookahead') or 0))]]
+    return {'songs': songs, 'lookahead': lookahead}
+
+  def api_playlist_dynamic_feedback(self, params):
+    if params.get('session_id') not in _sessions:
+      return self.error(5, 'no such session')
+    return {}
+
+  def api_song_profile(self, params):
+    song_id = params['id']
+    artist, number = int(song_id[2:10], 16), int(song_id[10:], 16)
+    return {'songs': [_song(str(artist), number, True)]}
+
+# Facebook
+
+LIKES = 40 # artists each user likes, on average
+PAGE_SIZE = 25
+
+_users = itertools.count(1)
+
+def _likes(fbid):
+  rng = random.Random(fbid)
+  return sorted(rng.sample(xrange(1, ARTISTS + 1), rng.randint(LIKES / 2, LIKES * 3 / 2)))
+
+class FacebookService(ServiceHandler):
+  error_status = 500
+
+  def do_GET(self):
+    url = urlparse(self.path)
+    params = self.params()
+    if url.path == '/dialog/oauth':
+      # Signs straight in as a brand new user.
+      redirect_uri = params['redirect_uri']
+      code = str(next(_users))
+      location = redirect_uri + ('&' if '?' in redirect_uri else '?') + urllib.urlencode({'code': code})
+      return self.redirect(location)
+    if url.path == '/oauth/access_token':
+      return self.form(200, {'access_token': 'fake-' + params['code'], 'expires': '5183999'})
+
+    token = params.get('access_token') or params.get('oauth_token') or ''
+    if not token.startswith('fake-'):
+      return self.respond(400, {'error': {'message': 'Invalid OAuth access token.', 'type': 'OAuthException', 'code': 190}})
+    fbid = token[len('fake-'):]
+
+    if url.path == '/me':
+      self.respond(200, {'id': fbid, 'name': 'User %s' % fbid})
+    elif url.path == '/me/music':
+      likes = _likes(fbid)
+      offset = int(params.get('offset') or 0)
+      page = [{'id': str(artist), 'name': 'Artist %d' % artist, 'category': 'Musician/band'}
+              for artist in likes[offset:offset + PAGE_SIZE]]
+      result = {'data': page}
+      if offset + PAGE_SIZE < len(likes):
+        query = urllib.urlencode({'access_token': token, 'offset': offset + PAGE_SIZE})
+        result['paging'] = {'next': 'http://%s:%d/me/music?%s' % (self.server.server_address + (query,))}
+      self.respond(200, result)
+    else:
+      self.respond(404, {'error': {'message': 'Unknown path ' + url.path, 'type': 'GraphMethodException'}})
+
+  def redirect(self, location):
+    self.send_response(302)
+    self.send_header('Location', location)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  def form(self, status, fields):
+    body = urllib.urlencode(fields)
+    self.send_response(status)
+    self.send_header('Content-Type', 'text/plain')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+HANDLERS = {'rdio': RdioService, 'echonest': EchoNestService, 'facebook': FacebookService}
+
+# serve : string, int, Faults -> fake_rdio.ThreadedServer
+def serve(name, port, faults=None):
+  server = fake_rdio.ThreadedServer(('localhost', port), HANDLERS[name])
+  server.faults = faults or Faults()
+  return server
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Fake Rdio, Echo Nest and Facebook APIs.')
+  parser.add_argument('--latency', type=float, default=0.0, help='mean added latency in ms')
+  parser.add_argument('--jitter', type=float, default=0.0, help='standard deviation of the latency in ms')
+  parser.add_argument('--errors', type=float, default=0.0, help='fraction of requests that fail')
+  for name in sorted(PORTS):
+    parser.add_argument('--%s-port' % name, type=int, default=PORTS[name])
+    parser.add_argument('--%s-latency' % name, type=float)
+    parser.add_argument('--%s-jitter' % name, type=float)
+    parser.add_argument('--%s-errors' % name, type=float)
+  args = vars(parser.parse_args(argv))
+
+  def setting(name, option):
+    value = args['%s_%s' % (name, option)]
+    return args[option] if value is None else value
+
+  for name in sorted(PORTS):
+    faults = Faults(setting(name, 'latency') / 1000.0, setting(name, 'jitter') / 1000.0, setting(name, 'errors'))
+    server = serve(name, args['%s_port' % name], faults)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print 'Fake %s listening on http://localhost:%d/ (%.0fms +/- %.0fms, %.1f%% errors)' % (
+      name, server.server_address[1], faults.latency * 1000, faults.jitter * 1000, faults.error_rate * 100)
+
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
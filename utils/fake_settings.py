@@ -0,0 +1,8 @@
+# Points musicroom at the fake services started by utils/fake_services.py:
+#
+#   MUSICROOM_SETTINGS=$PWD/utils/fake_settings.py python runserver.py
+
+RDIO_URL = 'http://localhost:8002/'
+ECHO_NEST_HOST = 'localhost:8003'
+FACEBOOK_URL = 'http://localhost:8004/'
+FACEBOOK_AUTHORIZE_URL = 'http://localhost:8004/dialog/oauth'
@@ -0,0 +1,219 @@
+# Drives a running musicroom with simulated room sessions and reports latency
+# percentiles and throughput for each route. Start the app against the fake
+# services first (see utils/fake_services.py and utils/fake_settings.py).
+#
+#   python utils/loadtest.py [--url URL] [--rooms N] [--listeners N] [--duration S]
+#                            [--storm N] [--think S] [--play-interval S]
+#
+# Each room gets an owner who signs in, creates it, starts it once someone has
+# joined and then skips to the next song every --play-interval seconds. Each
+# listener signs in, joins a room, opens its pages and then, until it moves on
+# to another room, alternates bursts of up to --storm likes and dislikes with
+# (long) polls of the room's state.
+
+import argparse
+import cookielib
+import json
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+# Paths are reported by route, with ids taken out.
+ROUTES = [
+  (re.compile(r'^/room/[^/]+/'), '/room/<id>/'),
+  (re.compile(r'^/jobs/[^/]+'), '/jobs/<id>'),
+]
+
+def route_of(path):
+  path = urlparse.urlparse(path).path
+  for pattern, replacement in ROUTES:
+    path = pattern.sub(replacement, path)
+  return path
+
+# percentile : float list, float -> float
+# the p'th percentile of the sorted samples, by nearest rank
+def percentile(samples, p):
+  if not samples:
+    return 0.0
+  rank = int(round(p / 100.0 * len(samples) + 0.5)) - 1
+  return samples[max(0, min(rank, len(samples) - 1))]
+
+class Stats(object):
+  """Response times and failures per route, shared by every client."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self._samples = {}
+      self._errors = {}
+      self._started = time.time()
+
+  def record(self, route, seconds, ok):
+    with self._lock:
+      self._samples.setdefault(route, []).append(seconds)
+      if not ok:
+        self._errors[route] = self._errors.get(route, 0) + 1
+
+  def report(self, out=sys.stdout):
+    with self._lock:
+      elapsed = time.time() - self._started
+      total = 0
+      out.write('%-32s %8s %7s %9s %9s %9s\n' % ('route', 'requests', 'errors', 'p50 ms', 'p99 ms', 'req/s'))
+      for route in sorted(self._samples):
+        samples = sorted(self._samples[route])
+        total += len(samples)
+        out.write('%-32s %8d %7d %9.1f %9.1f %9.1f\n' % (
+          route, len(samples), self._errors.get(route, 0),
+          percentile(samples, 50) * 1000, percentile(samples, 99) * 1000, len(samples) / elapsed))
+      out.write('%d requests in %.1fs, %.1f req/s\n' % (total, elapsed, total / elapsed))
+
+class NoRedirect(urllib2.HTTPRedirectHandler):
+  # Redirects come back as responses so that each hop is timed on its own.
+  def redirect_request(self, req, fp, code, msg, headers, newurl):
+    return None
+
+class Client(object):
+  """One simulated user, with their own cookies."""
+
+  def __init__(self, base_url, stats):
+    self.base_url = base_url.rstrip('/')
+    self.stats = stats
+    self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookielib.CookieJar()), NoRedirect())
+
+  # get : string, (string, string) dict -> (int, (string, string) dict, string)
+  # (status, headers, body) for a path on the app or an absolute URL; status
+  # is None if the request didn't get a response at all. Only requests to the
+  # app are recorded.
+  def get(self, path, headers={}):
+    url = path if '://' in path else self.base_url + path
+    start = time.time()
+    try:
+      response = self.opener.open(urllib2.Request(url, headers=headers))
+    except urllib2.HTTPError as e:
+      response = e
+    except (IOError, socket.error):
+      response = None
+    if response is None:
+      status, info, body = None, {}, ''
+    else:
+      status, info, body = response.code, response.info(), response.read()
+    if url.startswith(self.base_url):
+      self.stats.record(route_of(path), time.time() - start, status is not None and status < 500)
+    return status, info, body
+
+  # login : () -> boolean
+  # signs in through Facebook (the fake one signs everybody up as a new user)
+  def login(self):
+    status, info, body = self.get('/login')
+    for i in xrange(5):
+      if status is None or status not in (301, 302, 303):
+        break
+      status, info, body = self.get(info['Location'])
+    return status == 200
+
+  def json(self, path):
+    status, info, body = self.get(path)
+    if status != 200:
+      return None
+    return json.loads(body)
+
+def owner(client, room_id, args, stop):
+  client.get('/room/%s/playback' % room_id)
+  client.get('/playback_token')
+
+  # Rooms can't start without members.
+  job = None
+  while job is None and not stop.is_set():
+    job = client.json('/room/%s/action/start' % room_id)
+    if job is None:
+      stop.wait(1.0)
+  while not stop.is_set():
+    status = client.json('/jobs/%s' % job['job'])
+    if status is None or status['status'] in ('complete', 'error'):
+      break
+    stop.wait(0.2)
+
+  while not stop.is_set():
+    client.get('/room/%s/action/play' % room_id)
+    stop.wait(args.play_interval)
+
+def listener(client, room_ids, args, stop):
+  if not client.login():
+    return
+  client.get('/me/')
+  while not stop.is_set():
+    room_id = random.choice(room_ids)
+    client.get('/room/%s/join' % room_id)
+    client.get('/room/%s/' % room_id)
+    client.get('/room/%s/listen' % room_id)
+
+    etag = None
+    for i in xrange(random.randint(5, 20)):
+      if stop.is_set():
+        break
+      for j in xrange(random.randint(1, args.storm)):
+        client.get('/room/%s/action/%s' % (room_id, random.choice(['like', 'dislike'])))
+      query = urllib.urlencode({'wait': args.think}) if etag else ''
+      status, info, body = client.get('/room/%s/state?%s' % (room_id, query),
+                                      {'If-None-Match': etag} if etag else {})
+      if status == 200:
+        etag = info.get('ETag')
+      stop.wait(random.uniform(0, args.think))
+
+    client.get('/room/%s/leave' % room_id)
+
+# create_room : Client, string -> string
+# signs the owner in and creates a room, returning its id
+def create_room(client, name):
+  if not client.login():
+    raise SystemExit('could not sign in; is the app pointed at the fake services?')
+  client.get('/room/create?' + urllib.urlencode({'name': name}))
+  status, info, body = client.get('/me/')
+  match = re.search(r'href="/room/([^/"]+)/">%s<' % re.escape(name), body)
+  if match is None:
+    raise SystemExit('could not create room ' + name)
+  return match.group(1)
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Load test a running musicroom.')
+  parser.add_argument('--url', default='http://localhost:80', help='where the app is running')
+  parser.add_argument('--rooms', type=int, default=5)
+  parser.add_argument('--listeners', type=int, default=50, help='concurrent listeners')
+  parser.add_argument('--duration', type=float, default=60.0, help='seconds to run for')
+  parser.add_argument('--storm', type=int, default=10, help='most likes and dislikes in one burst')
+  parser.add_argument('--think', type=float, default=1.0, help='most seconds between bursts')
+  parser.add_argument('--play-interval', type=float, default=5.0, help='seconds between songs')
+  args = parser.parse_args(argv)
+
+  stats = Stats()
+  owners = [Client(args.url, stats) for i in xrange(args.rooms)]
+  room_ids = [create_room(client, 'loadtest %d %d' % (time.time(), i)) for i, client in enumerate(owners)]
+  stats.reset()
+
+  stop = threading.Event()
+  threads = [threading.Thread(target=owner, args=(client, room_id, args, stop))
+             for client, room_id in zip(owners, room_ids)]
+  threads += [threading.Thread(target=listener, args=(Client(args.url, stats), room_ids, args, stop))
+              for i in xrange(args.listeners)]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+
+  try:
+    time.sleep(args.duration)
+  except KeyboardInterrupt:
+    pass
+  stop.set()
+  stats.report()
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,100 @@
+# Brings a musicroom database up to date in place.
+#
+#   python utils/migrate.py [musicroom.db]          apply pending migrations
+#   python utils/migrate.py [musicroom.db] --check  fail if a hot query scans
+#
+# Migrations live in utils/migrations as NNN_description.sql and are applied
+# in order. The schema version is kept in sqlite's user_version pragma, so a
+# database freshly created from schema.sql is at version 0.
+
+import os
+import re
+import sqlite3
+import sys
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# The queries behind every page and action, with representative arguments.
+# None of them may fall back to scanning a whole table.
+HOT_QUERIES = [
+  ('select * from room where id = ?', ('abcdefgh',)),
+  ('select * from user where fbid = ?', ('1',)),
+  ('select * from memberof where user_fbid = ? and room_id = ?', ('1', 'abcdefgh')),
+  ('select user_fbid from memberof where room_id = ? and user_fbid > ? order by user_fbid limit ?',
+   ('abcdefgh', '', 100)),
+  ('select * from user where fbid in (?, ?)', ('1', '2')),
+  ('select artist_fbid from likes_artist where user_fbid = ?', ('1',)),
+  ('select room_id from memberof where user_fbid = ?', ('1',)),
+  ('update room_artist_count set count = count + ? where room_id = ? and artist_fbid = ? and '
+   'exists (select 1 from memberof where user_fbid = ? and room_id = ?)', (1, 'abcdefgh', '1', '1', 'abcdefgh')),
+  ('select num_members from room where id = ?', ('abcdefgh',)),
+  ('select artist_fbid, count from room_artist_count where room_id = ?', ('abcdefgh',)),
+  ('select sum(rating) from rates_song where room_id = ? group by room_id', ('abcdefgh',)),
+  ('delete from rates_song where room_id = ?', ('abcdefgh',)),
+  ('delete from memberof where room_id = ?', ('abcdefgh',)),
+  ('select R.id, R.name, R.num_members from room R where R.owner_fbid = ? order by R.id', ('1',)),
+  ('select R.id, R.name, R.num_members from memberof J, room R '
+   'where J.user_fbid = ? and R.id = J.room_id order by R.id', ('1',)),
+  ('select R.id, R.name, R.num_members from room R '
+   'where R.findable = 1 and R.id > ? order by R.id limit ?', ('', 50)),
+  ('select R.id, R.name, R.num_members, R.active_at from room R where R.findable = 1 '
+   'and R.num_members <= ? and (R.num_members < ? or R.id > ?) order by R.num_members desc, R.id limit ?',
+   (5, 5, 'abcdefgh', 20)),
+  ('select R.id, R.name, R.num_members, R.active_at from room R where R.findable = 1 '
+   'and R.active_at <= ? and (R.active_at < ? or R.id > ?) order by R.active_at desc, R.id limit ?',
+   (1400000000, 1400000000, 'abcdefgh', 20)),
+  ('select R.id, R.name, R.num_members, R.active_at from room_search S cross join room R '
+   'where room_search match ? and R.id = S.room_id and R.findable = 1 '
+   'order by R.num_members desc, R.id limit ?', ('"party"*', 20)),
+]
+
+# migrations : () -> (int, string) list
+def migrations():
+  result = []
+  for filename in sorted(os.listdir(MIGRATIONS)):
+    match = re.match(r'^(\d+)_.*\.sql$', filename)
+    if match:
+      result.append((int(match.group(1)), os.path.join(MIGRATIONS, filename)))
+  return result
+
+# migrate : sqlite3.Connection -> int
+# applies every migration newer than the database, each in its own
+# transaction, and returns the resulting version
+def migrate(conn):
+  version = conn.execute('pragma user_version').fetchone()[0]
+  for number, path in migrations():
+    if number <= version:
+      continue
+    print "Applying migration " + os.path.basename(path)
+    script = open(path).read()
+    conn.executescript('begin;\n%s\npragma user_version = %d;\ncommit;' % (script, number))
+    version = number
+  return version
+
+# A full text index answering a match shows up as a scan of the virtual table
+# with a constraint, e.g. 'SCAN S VIRTUAL TABLE INDEX 0:M1'.
+CONSTRAINED_VIRTUAL_TABLE = re.compile(r'VIRTUAL TABLE INDEX \d+:\S')
+
+# full_scans : sqlite3.Connection -> (string, string) list
+# the (query, plan step) pairs of hot queries that scan instead of search
+def full_scans(conn):
+  scans = []
+  for query, args in HOT_QUERIES:
+    for row in conn.execute('explain query plan ' + query, args):
+      detail = row[-1]
+      if detail.startswith('SCAN') and not CONSTRAINED_VIRTUAL_TABLE.search(detail):
+        scans.append((query, detail))
+  return scans
+
+if __name__ == '__main__':
+  args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+  path = args[0] if args else 'musicroom.db'
+  conn = sqlite3.connect(path)
+
+  if '--check' in sys.argv:
+    scans = full_scans(conn)
+    for query, detail in scans:
+      print detail + ': ' + query
+    sys.exit(1 if scans else 0)
+
+  print "Database is at version %d" % migrate(conn)
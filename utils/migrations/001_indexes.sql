@@ -0,0 +1,25 @@
+-- rates_song.room_id was declared integer while room.id is a varchar, so the
+-- column had integer affinity and comparisons against room ids could not use
+-- an index. SQLite can't alter a column type, so rebuild the table.
+create table rates_song_new (
+  user_fbid varchar(20),
+  room_id varchar(20),
+  rating integer,
+  primary key (user_fbid, room_id),
+  foreign key (user_fbid) references user(fbid),
+  foreign key (room_id) references room(id),
+  check (rating in (-1, 1))
+);
+insert into rates_song_new select user_fbid, cast(room_id as text), rating from rates_song;
+drop table rates_song;
+alter table rates_song_new rename to rates_song;
+
+-- members(), num_members(), artist_counts() and delete() look up by room.
+create index memberof_room on memberof (room_id, user_fbid);
+
+-- get_cur_rating() sums the ratings of one room.
+create index rates_song_room on rates_song (room_id, rating);
+
+-- owned_rooms() and the public_rooms() keyset pages.
+create index room_owner on room (owner_fbid, id);
+create index room_findable on room (findable, id);
@@ -0,0 +1,3 @@
+-- When a user's liked artists were last imported from Facebook, in seconds
+-- since the epoch. Used to schedule re-syncs.
+alter table user add column synced_at integer;
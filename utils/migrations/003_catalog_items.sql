@@ -0,0 +1,9 @@
+-- What was last pushed to each room's Echo Nest seed catalog, so that only
+-- the difference needs to be sent.
+create table catalog_item (
+  room_id varchar(20),
+  artist_fbid varchar(20),
+  play_count integer not null,
+  primary key (room_id, artist_fbid),
+  foreign key (room_id) references room(id)
+);
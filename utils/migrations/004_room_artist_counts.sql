@@ -0,0 +1,46 @@
+-- How many members of each room like each artist, kept up to date by the
+-- triggers below whenever memberships or likes change, so that reading a
+-- room's tastes doesn't need a join over every member's likes.
+create table room_artist_count (
+  room_id varchar(20),
+  artist_fbid varchar(20),
+  count integer not null,
+  primary key (room_id, artist_fbid),
+  foreign key (room_id) references room(id)
+);
+
+insert into room_artist_count
+  select M.room_id, L.artist_fbid, count(L.user_fbid) from memberof M, likes_artist L
+  where M.user_fbid = L.user_fbid group by M.room_id, L.artist_fbid;
+
+create trigger memberof_insert_counts after insert on memberof begin
+  insert or ignore into room_artist_count
+    select new.room_id, artist_fbid, 0 from likes_artist where user_fbid = new.user_fbid;
+  update room_artist_count set count = count + 1
+    where room_id = new.room_id
+    and artist_fbid in (select artist_fbid from likes_artist where user_fbid = new.user_fbid);
+end;
+
+create trigger memberof_delete_counts after delete on memberof begin
+  update room_artist_count set count = count - 1
+    where room_id = old.room_id
+    and artist_fbid in (select artist_fbid from likes_artist where user_fbid = old.user_fbid);
+  delete from room_artist_count where room_id = old.room_id and count <= 0;
+end;
+
+create trigger likes_artist_insert_counts after insert on likes_artist begin
+  insert or ignore into room_artist_count
+    select room_id, new.artist_fbid, 0 from memberof where user_fbid = new.user_fbid;
+  update room_artist_count set count = count + 1
+    where artist_fbid = new.artist_fbid
+    and room_id in (select room_id from memberof where user_fbid = new.user_fbid);
+end;
+
+create trigger likes_artist_delete_counts after delete on likes_artist begin
+  update room_artist_count set count = count - 1
+    where artist_fbid = old.artist_fbid
+    and room_id in (select room_id from memberof where user_fbid = old.user_fbid);
+  delete from room_artist_count
+    where artist_fbid = old.artist_fbid and count <= 0
+    and room_id in (select room_id from memberof where user_fbid = old.user_fbid);
+end;
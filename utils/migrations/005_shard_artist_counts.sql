@@ -0,0 +1,8 @@
+-- Rooms can live in another database than their members' likes (see
+-- musicroom/shards.py), where these triggers couldn't see both sides. The
+-- app now writes the count changes itself, in the same write as the join,
+-- leave or change of likes (models.artist_count_changes).
+drop trigger if exists memberof_insert_counts;
+drop trigger if exists memberof_delete_counts;
+drop trigger if exists likes_artist_insert_counts;
+drop trigger if exists likes_artist_delete_counts;
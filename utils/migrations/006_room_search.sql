@@ -0,0 +1,28 @@
+-- Room discovery sorts by how many members a room has or how recently it was
+-- active (joined, left or moved on to a new song), so both are kept on the
+-- room itself and indexed in the order they're listed in.
+alter table room add column num_members integer not null default 0;
+alter table room add column active_at integer not null default 0;
+
+update room set num_members = (select count(*) from memberof M where M.room_id = room.id);
+
+create index room_members on room (findable, num_members desc, id);
+create index room_activity on room (findable, active_at desc, id);
+
+-- Full text search over room names, kept in step with the room table.
+create virtual table room_search using fts5 (name, content = 'room', content_rowid = 'rowid', prefix = '2 3');
+
+insert into room_search (rowid, name) select rowid, name from room;
+
+create trigger room_search_insert after insert on room begin
+  insert into room_search (rowid, name) values (new.rowid, new.name);
+end;
+
+create trigger room_search_delete after delete on room begin
+  insert into room_search (room_search, rowid, name) values ('delete', old.rowid, old.name);
+end;
+
+create trigger room_search_update after update of name on room begin
+  insert into room_search (room_search, rowid, name) values ('delete', old.rowid, old.name);
+  insert into room_search (rowid, name) values (new.rowid, new.name);
+end;
@@ -0,0 +1,27 @@
+-- The name index pointed at rooms by their implicit rowid, which VACUUM may
+-- renumber. It now keeps its own rows, each with the id of its room, and the
+-- room keeps the rowid of its row there (search_rowid) for the triggers.
+drop trigger if exists room_search_insert;
+drop trigger if exists room_search_delete;
+drop trigger if exists room_search_update;
+drop table if exists room_search;
+
+alter table room add column search_rowid integer;
+
+create virtual table room_search using fts5 (name, room_id unindexed, prefix = '2 3');
+
+insert into room_search (rowid, name, room_id) select rowid, name, id from room;
+update room set search_rowid = rowid;
+
+create trigger room_search_insert after insert on room begin
+  insert into room_search (name, room_id) values (new.name, new.id);
+  update room set search_rowid = last_insert_rowid() where id = new.id;
+end;
+
+create trigger room_search_delete after delete on room begin
+  delete from room_search where rowid = old.search_rowid;
+end;
+
+create trigger room_search_update after update of name on room begin
+  update room_search set name = new.name where rowid = old.search_rowid;
+end;
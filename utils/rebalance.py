@@ -0,0 +1,125 @@
+# Moves rooms onto the shard the hash ring now gives them, after shards have
+# been added or removed (see musicroom/shards.py).
+#
+#   MUSICROOM_SHARDS='{"a": ["rooms-a.db", "redis://..."], ...}' \
+#     python utils/rebalance.py [--dry-run] [room_id ...]
+#
+# Rooms are looked for in every configured shard and in the main DATABASE
+# and REDIS_URL (where they all are before the first shards are set up). A
+# misplaced room's rows are copied to its shard in one transaction, its redis
+# keys follow with DUMP/RESTORE (keeping their expiry), and only then is it
+# deleted from where it was. Create and migrate every shard's database first
+# (utils/schema.sql, utils/migrate.py), and run this with the new settings
+# while the app is stopped: until a room has moved, the app can't find it.
+
+import argparse
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import musicroom
+from musicroom import create_app, shards, roomstate, votes, lookahead
+
+# The tables rows of a room are in, with the column naming the room. The
+# room itself goes last when deleting.
+ROOM_TABLES = [
+  ('memberof', 'room_id'),
+  ('rates_song', 'room_id'),
+  ('catalog_item', 'room_id'),
+  ('room_artist_count', 'room_id'),
+  ('room', 'id'),
+]
+
+# Everything a room keeps in redis.
+ROOM_KEYS = [roomstate._key, roomstate._version_key, votes._votes_key, votes._tally_key,
+             lookahead._upcoming_key, lookahead._queued_key]
+
+class Place(object):
+  """A database and redis that rooms can be found in."""
+
+  def __init__(self, name, database, redis_url, redis):
+    self.name = name
+    self.database = database
+    self.redis_url = redis_url
+    self.redis = redis
+    self.conn = sqlite3.connect(database, timeout=30.0)
+
+  def version(self):
+    return self.conn.execute('pragma user_version').fetchone()[0]
+
+  def room_ids(self):
+    return [row[0] for row in self.conn.execute('select id from room order by id')]
+
+# places : () -> (string, Place) dict
+# every shard and the main database, by database path
+def places():
+  result = {}
+  for shard in shards.every():
+    result.setdefault(os.path.abspath(shard.database),
+                      Place(shard.name, shard.database, shard.redis_url, shard.redis))
+  config = musicroom.app.config
+  result.setdefault(os.path.abspath(config['DATABASE']),
+                    Place('main', config['DATABASE'], config['REDIS_URL'], musicroom.redis))
+  return result
+
+# move : string, Place, Place -> ()
+def move(room_id, source, target):
+  rows = []
+  for table, column in ROOM_TABLES:
+    for row in source.conn.execute('select * from %s where %s = ?' % (table, column), (room_id,)):
+      rows.append(('insert into %s values (%s)' % (table, ', '.join('?' * len(row))), row))
+  # Anything left over from an earlier, interrupted run is deleted rather
+  # than replaced, so that the room name index's triggers see it go.
+  with target.conn:
+    for table, column in ROOM_TABLES:
+      target.conn.execute('delete from %s where %s = ?' % (table, column), (room_id,))
+    for sql, row in rows:
+      target.conn.execute(sql, row)
+
+  if source.redis_url != target.redis_url:
+    for key in [key_of(room_id) for key_of in ROOM_KEYS]:
+      value = source.redis.execute_command('DUMP', key)
+      if value is None:
+        continue
+      ttl = source.redis.pttl(key)
+      pipe = target.redis.pipeline()
+      pipe.delete(key)
+      pipe.execute_command('RESTORE', key, max(ttl, 0), value)
+      pipe.execute()
+      source.redis.delete(key)
+
+  with source.conn:
+    for table, column in ROOM_TABLES:
+      source.conn.execute('delete from %s where %s = ?' % (table, column), (room_id,))
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Move rooms to the shards they hash to.')
+  parser.add_argument('--dry-run', action='store_true', help='only list the rooms that would move')
+  parser.add_argument('room_ids', nargs='*', help='only move these rooms')
+  args = parser.parse_args(argv)
+
+  create_app()
+  by_database = places()
+  versions = set(place.version() for place in by_database.itervalues())
+  if len(versions) > 1:
+    raise SystemExit('databases are at different schema versions; run utils/migrate.py on each first')
+
+  moved = 0
+  for path, source in sorted(by_database.iteritems()):
+    for room_id in source.room_ids():
+      if args.room_ids and room_id not in args.room_ids:
+        continue
+      shard = shards.for_room(room_id)
+      target = by_database[os.path.abspath(shard.database)]
+      if target is source:
+        continue
+      print 'room %s: %s -> %s' % (room_id, source.name, target.name)
+      if not args.dry_run:
+        move(room_id, source, target)
+      moved += 1
+  print '%s %d rooms' % ('Would move' if args.dry_run else 'Moved', moved)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
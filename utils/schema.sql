@@ -1,3 +1,10 @@
+-- The baseline schema. utils/migrate.py brings it up to date; tables the
+-- migrations add are dropped here too, so that running this over an existing
+-- database (as utils/reset does) starts the migrations over from the start.
+drop table if exists room_search;
+drop table if exists room_artist_count;
+drop table if exists catalog_item;
+drop table if exists rates_song_new;
 drop table if exists likes_artist;
 drop table if exists rates_song;
 drop table if exists memberof;
@@ -56,3 +63,5 @@ create table likes_artist (
   primary key (user_fbid, artist_fbid),
   foreign key (user_fbid) references user(fbid)
 );
+
+pragma user_version = 0;
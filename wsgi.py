@@ -0,0 +1,8 @@
+# For pre-forking servers, e.g.
+#
+#   MUSICROOM_DATABASE=/var/lib/musicroom.db gunicorn -w 8 -k gthread --threads 16 wsgi:app
+#
+# Each worker makes its own connections the first time it needs them.
+from musicroom import create_app
+
+app = create_app()